@@ -0,0 +1,302 @@
+"""
+Stand-in for the HTTP API of a Nomad agent, for benchmarking.
+
+Only the endpoints used by nomad-service are implemented, with a
+configurable latency per call, together with streaming endpoints
+(event stream and allocation logs) sending a configurable amount of data,
+a large allocation listing, and an "alloc exec" WebSocket that echoes
+stdin back as stdout. Nothing is persisted.
+
+When the "x-benchmark-interval" query parameter is given, the event
+stream instead drips "x-benchmark-events" single events, one every that
+many seconds. These parameters are not something Nomad knows about.
+"""
+
+import aiohttp
+import asyncio
+import base64
+import gzip
+import json
+import sys
+
+from aiohttp import web
+
+JOBSPEC = """
+job "[[ service ]]" {
+  datacenters = ["public"]
+
+  group "app" {
+    task "app" {
+      driver = "docker"
+
+      config {
+        image = "[[ image ]]:[[ version ]]"
+      }
+    }
+  }
+}
+"""
+
+
+class FakeNomad:
+    def __init__(self, latency=0.0, stream_size=0, stream_chunk=16 * 1024, stream_interval=0.0, list_size=0):
+        self.latency = latency
+        self.stream_size = stream_size
+        self.stream_chunk = stream_chunk
+        self.stream_interval = stream_interval
+        self.list_size = list_size
+        self._allocations = None
+        self.index = 100
+        self.variables = {}
+        self.evaluations = {}
+        self.jobs = {}
+        self.deployments = {}
+        self.requests = 0
+
+    def add_service(self, service):
+        self.variables[f"app/{service}/settings"] = self._variable(
+            f"app/{service}/settings", {"service": service, "image": f"ghcr.io/openttd/{service}"}
+        )
+        self.variables[f"app/{service}/jobspec"] = self._variable(
+            f"app/{service}/jobspec", {"jobspec": base64.b64encode(JOBSPEC.encode()).decode()}
+        )
+
+    def _variable(self, path, items):
+        self.index += 1
+        return {"Path": path, "Items": items, "CreateIndex": self.index, "ModifyIndex": self.index}
+
+    async def _delay(self):
+        self.requests += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+    async def var_list(self, request):
+        await self._delay()
+        prefix = request.query.get("prefix", "")
+        return web.json_response(
+            [
+                {"Path": path, "ModifyIndex": variable["ModifyIndex"]}
+                for path, variable in self.variables.items()
+                if path.startswith(prefix)
+            ]
+        )
+
+    async def var_get(self, request):
+        await self._delay()
+        path = request.match_info["path"]
+        if path not in self.variables:
+            return web.HTTPNotFound()
+        return web.json_response(self.variables[path])
+
+    async def var_put(self, request):
+        await self._delay()
+        path = request.match_info["path"]
+        payload = await request.json()
+        self.variables[path] = self._variable(path, payload["Items"])
+        return web.json_response(self.variables[path])
+
+    async def job_parse(self, request):
+        await self._delay()
+        payload = await request.json()
+        return web.json_response({"ID": payload["JobHCL"].split('"')[1], "Name": "fake", "Spec": payload["JobHCL"]})
+
+    async def job_register(self, request):
+        await self._delay()
+        job = (await request.json())["Job"]
+        self.index += 1
+
+        # Like Nomad, only a changed job gets a new JobModifyIndex and a deployment.
+        deployment_id = ""
+        if job["ID"] in self.jobs and self.jobs[job["ID"]][1] == job:
+            job_modify_index = self.jobs[job["ID"]][0]
+        else:
+            job_modify_index = self.index
+            self.jobs[job["ID"]] = (job_modify_index, job)
+            deployment_id = f"deployment-{job['ID']}-{job_modify_index}"
+            self.deployments[job["ID"]] = {
+                "ID": deployment_id,
+                "JobModifyIndex": job_modify_index,
+                "Status": "running",
+                "StatusDescription": "Deployment is running",
+            }
+
+        eval_id = f"eval-{self.index}"
+        self.evaluations[eval_id] = {
+            "ID": eval_id,
+            "JobID": job["ID"],
+            "Status": "complete",
+            "DeploymentID": deployment_id,
+        }
+        return web.json_response({"EvalID": eval_id, "JobModifyIndex": job_modify_index, "Warnings": ""})
+
+    async def evaluation(self, request):
+        await self._delay()
+        eval_id = request.match_info["eval"]
+        if eval_id not in self.evaluations:
+            return web.HTTPNotFound()
+        return web.json_response(self.evaluations[eval_id])
+
+    async def evaluation_allocations(self, request):
+        await self._delay()
+        return web.json_response([])
+
+    async def deployment(self, request):
+        await self._delay()
+        for deployment in self.deployments.values():
+            if deployment["ID"] == request.match_info["deployment"]:
+                return web.json_response(deployment)
+        return web.HTTPNotFound()
+
+    async def job_deployment(self, request):
+        await self._delay()
+        return web.json_response(self.deployments.get(request.match_info["job"]))
+
+    async def _stream(self, request, chunk):
+        """
+        Send "chunk" till stream_size bytes are sent.
+        """
+
+        response = web.StreamResponse()
+        response.headers["Content-Type"] = "application/json"
+        await response.prepare(request)
+
+        sent = 0
+        while sent < self.stream_size:
+            await response.write(chunk)
+            sent += len(chunk)
+
+            if self.stream_interval:
+                await asyncio.sleep(self.stream_interval)
+
+        return response
+
+    async def allocations(self, request):
+        await self._delay()
+
+        # Build the listing (and its compressed form, as Nomad compresses when it can) only once.
+        if self._allocations is None:
+            allocations = [
+                {
+                    "ID": f"{i:08x}-0000-0000-0000-000000000000",
+                    "JobID": f"job-{i % 50}",
+                    "TaskGroup": "app",
+                    "NodeID": f"{i % 10:08x}-0000-0000-0000-000000000000",
+                    "ClientStatus": "running",
+                    "DesiredStatus": "run",
+                    "TaskStates": {"app": {"State": "running", "Failed": False, "Restarts": 0}},
+                    "CreateIndex": i,
+                    "ModifyIndex": i,
+                }
+                for i in range(self.list_size)
+            ]
+            body = json.dumps(allocations).encode()
+            self._allocations = (body, gzip.compress(body))
+
+        headers = {"Content-Type": "application/json", "X-Nomad-Index": str(self.index)}
+        if "gzip" in request.headers.get("Accept-Encoding", ""):
+            headers["Content-Encoding"] = "gzip"
+            return web.Response(body=self._allocations[1], headers=headers)
+        return web.Response(body=self._allocations[0], headers=headers)
+
+    async def _drip(self, request, interval, count):
+        response = web.StreamResponse()
+        response.headers["Content-Type"] = "application/json"
+        await response.prepare(request)
+
+        try:
+            for index in range(count):
+                await asyncio.sleep(interval)
+                event = {"Index": index, "Events": [{"Topic": "Node", "Payload": {}}]}
+                await response.write(json.dumps(event).encode() + b"\n")
+        except ConnectionResetError:
+            # The benchmark hangs up after the first event.
+            pass
+
+        return response
+
+    async def event_stream(self, request):
+        await self._delay()
+
+        if "x-benchmark-interval" in request.query:
+            return await self._drip(
+                request,
+                float(request.query["x-benchmark-interval"]),
+                int(request.query.get("x-benchmark-events", "10")),
+            )
+
+        # Without a job to follow, behave like a busy cluster streaming all its events.
+        topics = request.query.getall("topic", [])
+        if not topics or ":" not in topics[0] or topics[0].endswith(":*"):
+            padding = "x" * max(0, self.stream_chunk - 80)
+            event = {"Index": self.index, "Events": [{"Topic": "Node", "Payload": {"Padding": padding}}]}
+            return await self._stream(request, json.dumps(event).encode() + b"\n")
+
+        job_id = topics[0].split(":", 1)[1]
+        index = int(request.query["index"])
+        deployment = {
+            "ID": f"deployment-{job_id}-{index}",
+            "JobModifyIndex": index,
+            "Status": "successful",
+            "StatusDescription": "Deployment completed successfully",
+        }
+
+        response = web.StreamResponse()
+        await response.prepare(request)
+        event = {"Index": index, "Events": [{"Topic": "Deployment", "Payload": {"Deployment": deployment}}]}
+        await response.write(json.dumps(event).encode() + b"\n")
+        return response
+
+    async def logs(self, request):
+        await self._delay()
+        return await self._stream(
+            request, b"2024-01-01T00:00:00Z [INFO] benchmark log line\n" * (self.stream_chunk // 48)
+        )
+
+    async def exec(self, request):
+        await self._delay()
+
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+
+        async for message in ws:
+            if message.type != aiohttp.WSMsgType.TEXT:
+                break
+
+            frame = json.loads(message.data)
+            if "stdin" in frame and "data" in frame["stdin"]:
+                await ws.send_str(json.dumps({"stdout": {"data": frame["stdin"]["data"]}}))
+
+        return ws
+
+    def create_app(self):
+        app = web.Application()
+        app.router.add_get("/v1/vars", self.var_list)
+        app.router.add_get("/v1/var/{path:.*}", self.var_get)
+        app.router.add_put("/v1/var/{path:.*}", self.var_put)
+        app.router.add_post("/v1/jobs/parse", self.job_parse)
+        app.router.add_post("/v1/jobs", self.job_register)
+        app.router.add_get("/v1/evaluation/{eval}", self.evaluation)
+        app.router.add_get("/v1/evaluation/{eval}/allocations", self.evaluation_allocations)
+        app.router.add_get("/v1/deployment/{deployment}", self.deployment)
+        app.router.add_get("/v1/job/{job}/deployment", self.job_deployment)
+        app.router.add_get("/v1/allocations", self.allocations)
+        app.router.add_get("/v1/event/stream", self.event_stream)
+        app.router.add_get("/v1/client/fs/logs/{alloc}", self.logs)
+        app.router.add_get("/v1/client/allocation/{alloc}/exec", self.exec)
+        return app
+
+
+def main():
+    if len(sys.argv) < 2:
+        print(f"Usage: {sys.argv[0]} <port> [latency] [service ...]")
+        sys.exit(1)
+
+    nomad = FakeNomad(float(sys.argv[2]) if len(sys.argv) > 2 else 0.0)
+    for service in sys.argv[3:]:
+        nomad.add_service(service)
+
+    web.run_app(nomad.create_app(), port=int(sys.argv[1]))
+
+
+if __name__ == "__main__":
+    main()
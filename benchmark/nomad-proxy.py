@@ -0,0 +1,328 @@
+"""
+Benchmark the Nomad proxies against a fake Nomad agent.
+
+The proxy is started as a subprocess, in front of an in-process fake Nomad
+agent; nothing leaves the machine. Against every proxy, these scenarios
+are run in turn:
+
+  - list: clients fetch a large allocation listing over and over;
+    requests/s, latency and MB/s are reported.
+  - event-stream / logs: clients read long-lived streams; relay
+    throughput, CPU time the proxy spends per MB, and time-to-first-byte
+    are reported.
+  - drip: clients follow an event stream that only sends an event now
+    and then; time-to-first-byte shows whether the proxy holds back data.
+  - exec: an "alloc exec" session measures the keystroke round-trip time.
+
+"list" and "exec" are also run directly against the fake agent, as a
+baseline. The peak RSS of every proxy is reported too. Everything is
+reported as JSON, so runs can be compared across commits.
+
+Usage (from the root of this repository):
+
+    .env/bin/python benchmark/nomad-proxy.py --proxy cluster --stream-size 64 --clients 4
+"""
+
+import aiohttp
+import argparse
+import asyncio
+import base64
+import json
+import os
+import socket
+import sys
+import time
+
+from aiohttp import web
+
+from fake_nomad import FakeNomad
+
+ROOT = os.path.join(os.path.dirname(__file__), "..")
+CLUSTER_PROXY = os.path.join(ROOT, "nomad-core", "files", "nomad-proxy.py")
+
+STREAMS = {
+    "event-stream": "v1/event/stream",
+    "logs": "v1/client/fs/logs/benchmark?task=app&type=stdout&follow=true&plain=true",
+}
+LIST = "v1/allocations"
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def read_cpu(pid):
+    """
+    Return the user + system CPU time of a process in seconds.
+    """
+
+    with open(f"/proc/{pid}/stat") as fp:
+        fields = fp.read().rsplit(")", 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+
+def read_peak_rss(pid):
+    """
+    Return the peak RSS in KiB of a process.
+    """
+
+    with open(f"/proc/{pid}/status") as fp:
+        for line in fp:
+            if line.startswith("VmHWM:"):
+                return int(line.split()[1])
+    return None
+
+
+async def start_proxy(kind, upstream_port, cache_ttl):
+    port = free_port()
+    env = dict(os.environ)
+    env["CACHE_TTL"] = str(cache_ttl)
+
+    if kind == "cluster":
+        env["NOMAD_PROXY_UPSTREAM"] = f"http://127.0.0.1:{upstream_port}"
+        env["NOMAD_PROXY_PORT"] = str(port)
+        args = [CLUSTER_PROXY]
+    else:
+        env["CF_ACCESS_CLIENT_ID"] = "benchmark"
+        env["CF_ACCESS_CLIENT_SECRET"] = "benchmark"
+        args = ["-m", "nomad-proxy", f"http://127.0.0.1:{upstream_port}", str(port)]
+
+    proc = await asyncio.create_subprocess_exec(
+        sys.executable,
+        *args,
+        cwd=ROOT,
+        env=env,
+        stdout=asyncio.subprocess.DEVNULL,
+        stderr=asyncio.subprocess.DEVNULL,
+    )
+
+    # Wait for the proxy to come online.
+    for _ in range(100):
+        try:
+            reader, writer = await asyncio.open_connection("127.0.0.1", port)
+            writer.close()
+            break
+        except OSError:
+            await asyncio.sleep(0.1)
+    else:
+        proc.kill()
+        raise RuntimeError(f"{kind} proxy did not start")
+
+    return proc, f"http://127.0.0.1:{port}"
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return round(values[min(len(values) - 1, int(len(values) * fraction))], 6)
+
+
+def summarize(values):
+    return {
+        "p50": percentile(values, 0.50),
+        "p99": percentile(values, 0.99),
+        "max": round(max(values), 6),
+    }
+
+
+async def bench_stream(session, proxy, base_url, path, clients):
+    ttfb = []
+
+    async def client():
+        received = 0
+        start = time.monotonic()
+        async with session.get(f"{base_url}/{path}") as response:
+            async for chunk in response.content.iter_any():
+                if not received:
+                    ttfb.append(time.monotonic() - start)
+                received += len(chunk)
+        return received
+
+    cpu = read_cpu(proxy.pid)
+    start = time.monotonic()
+    received = sum(await asyncio.gather(*[client() for _ in range(clients)]))
+    elapsed = time.monotonic() - start
+    cpu = read_cpu(proxy.pid) - cpu
+
+    mb = received / (1024 * 1024)
+    return {
+        "bytes": received,
+        "elapsed": round(elapsed, 3),
+        "mb_per_second": round(mb / elapsed, 3),
+        "cpu_seconds": round(cpu, 3),
+        "cpu_seconds_per_mb": round(cpu / mb, 6) if mb else None,
+        "ttfb": summarize(ttfb),
+    }
+
+
+async def bench_list(session, proxy, base_url, clients, duration):
+    """
+    Fetch the allocation listing from several clients for "duration" seconds.
+    """
+
+    latencies = []
+    errors = 0
+    received = 0
+
+    async def client(deadline):
+        nonlocal errors, received
+
+        while time.monotonic() < deadline:
+            start = time.monotonic()
+            async with session.get(f"{base_url}/{LIST}") as response:
+                body = await response.read()
+                if response.status != 200:
+                    errors += 1
+            latencies.append(time.monotonic() - start)
+            received += len(body)
+
+    cpu = read_cpu(proxy.pid) if proxy else 0
+    start = time.monotonic()
+    await asyncio.gather(*[client(start + duration) for _ in range(clients)])
+    elapsed = time.monotonic() - start
+    cpu = read_cpu(proxy.pid) - cpu if proxy else None
+
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "requests_per_second": round(len(latencies) / elapsed, 3),
+        "latency": summarize(latencies),
+        "mb_per_second": round(received / (1024 * 1024) / elapsed, 3),
+        "cpu_seconds": round(cpu, 3) if proxy else None,
+    }
+
+
+async def bench_drip(session, base_url, clients, interval, events):
+    """
+    Follow a quiet event stream, and time when the first byte and the first event arrive.
+    """
+
+    ttfb = []
+    first_event = []
+
+    async def client():
+        start = time.monotonic()
+        received = False
+        async with session.get(
+            f"{base_url}/v1/event/stream?x-benchmark-interval={interval}&x-benchmark-events={events}"
+        ) as response:
+            async for line in response.content:
+                if not received:
+                    ttfb.append(time.monotonic() - start)
+                    received = True
+                # Heartbeats don't count as an event.
+                if line.strip() not in (b"", b"{}"):
+                    first_event.append(time.monotonic() - start)
+                    break
+
+    await asyncio.gather(*[client() for _ in range(clients)])
+    return {
+        "interval": interval,
+        "ttfb": summarize(ttfb),
+        "first_event": summarize(first_event),
+    }
+
+
+async def bench_exec(session, base_url, keystrokes):
+    """
+    Send keystrokes one by one over an exec session, and time how long each takes to be echoed back.
+    """
+
+    round_trips = []
+    async with session.ws_connect(f"{base_url}/v1/client/allocation/benchmark/exec?task=app") as ws:
+        for i in range(keystrokes):
+            data = base64.b64encode(chr(ord("a") + i % 26).encode()).decode()
+
+            start = time.monotonic()
+            await ws.send_str(json.dumps({"stdin": {"data": data}}))
+            message = await ws.receive()
+            round_trips.append(time.monotonic() - start)
+
+            if json.loads(message.data)["stdout"]["data"] != data:
+                raise RuntimeError("exec echo returned unexpected data")
+
+    return {
+        "keystrokes": keystrokes,
+        "p50": percentile(round_trips, 0.50),
+        "p99": percentile(round_trips, 0.99),
+        "max": round(max(round_trips), 6),
+    }
+
+
+async def run(args):
+    nomad = FakeNomad(
+        stream_size=args.stream_size * 1024 * 1024, stream_chunk=args.stream_chunk, list_size=args.list_size
+    )
+    runner = web.AppRunner(nomad.create_app())
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    upstream_port = runner.addresses[0][1]
+
+    result = {
+        "config": {
+            "stream_size_mb": args.stream_size,
+            "stream_chunk": args.stream_chunk,
+            "clients": args.clients,
+            "list_size": args.list_size,
+            "duration": args.duration,
+            "drip_interval": args.drip_interval,
+            "cache_ttl": args.cache_ttl,
+            "keystrokes": args.keystrokes,
+        },
+        "proxies": {},
+    }
+
+    direct_url = f"http://127.0.0.1:{upstream_port}"
+    async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=0)) as session:
+        result["direct"] = {
+            "list": await bench_list(session, None, direct_url, args.clients, args.duration),
+            "exec": await bench_exec(session, direct_url, args.keystrokes),
+        }
+
+    kinds = ["cluster", "operator"] if args.proxy == "both" else [args.proxy]
+    for kind in kinds:
+        proxy, base_url = await start_proxy(kind, upstream_port, args.cache_ttl)
+
+        async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=0)) as session:
+            proxy_result = {"list": await bench_list(session, proxy, base_url, args.clients, args.duration)}
+            for name, path in STREAMS.items():
+                proxy_result[name] = await bench_stream(session, proxy, base_url, path, args.clients)
+            proxy_result["drip"] = await bench_drip(session, base_url, args.clients, args.drip_interval, 3)
+            proxy_result["exec"] = await bench_exec(session, base_url, args.keystrokes)
+            proxy_result["peak_rss_kib"] = read_peak_rss(proxy.pid)
+            result["proxies"][kind] = proxy_result
+
+        proxy.terminate()
+        await proxy.wait()
+
+    await runner.cleanup()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the Nomad proxies.")
+    parser.add_argument("--proxy", choices=("cluster", "operator", "both"), default="both", help="proxy to benchmark")
+    parser.add_argument("--stream-size", type=int, default=64, help="MB sent per stream")
+    parser.add_argument("--stream-chunk", type=int, default=16 * 1024, help="bytes per chunk sent by Nomad")
+    parser.add_argument("--clients", type=int, default=4, help="number of parallel streams")
+    parser.add_argument("--list-size", type=int, default=5000, help="number of allocations in the listing")
+    parser.add_argument("--duration", type=float, default=5, help="seconds to fetch the listing for")
+    parser.add_argument("--drip-interval", type=float, default=2, help="seconds between events on the quiet stream")
+    parser.add_argument("--cache-ttl", type=float, default=0, help="CACHE_TTL of the proxies; 0 disables their cache")
+    parser.add_argument("--keystrokes", type=int, default=1000, help="number of keystrokes sent over alloc exec")
+    parser.add_argument("--output", help="write the JSON result to this file instead of stdout")
+    args = parser.parse_args()
+
+    result = asyncio.run(run(args))
+
+    if args.output:
+        with open(args.output, "w") as fp:
+            json.dump(result, fp, indent=2)
+    else:
+        print(json.dumps(result, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,317 @@
+"""
+Load-test nomad-service against a fake Nomad agent and fake "nomad" / "aws" executables.
+
+nomad-service is started as a subprocess (just like on the cluster), after
+which a configurable mix of /deploy, /reload and /autoscaling traffic is
+fired at it. The result is written as JSON, so runs can be compared across
+commits.
+
+Usage (from the root of this repository):
+
+    .env/bin/python benchmark/nomad-service.py --duration 30 --concurrency 20 --mix deploy=2,reload=1,autoscaling=1
+"""
+
+import aiohttp
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import random
+import shutil
+import socket
+import sys
+import tempfile
+import time
+
+from aiohttp import web
+
+from fake_nomad import FakeNomad
+
+NOMAD_SERVICE = os.path.join(os.path.dirname(__file__), "..", "nomad-core", "files", "nomad-service.py")
+SERVICE_KEY = "benchmark"
+
+FAKE_AWS = """#!/bin/sh
+sleep {latency}
+case "$*" in
+  *describe-instances*)
+    ids=$(echo "$*" | sed 's/.*--instance-ids \\(.*\\) --query.*/\\1/')
+    {python} -c 'import json, sys; print(json.dumps([[i, "ip-" + i] for i in sys.argv[1:]]))' $ids
+    ;;
+esac
+"""
+
+FAKE_NOMAD = """#!/bin/sh
+sleep {latency}
+case "$*" in
+  *"node status"*) echo "node-$$" ;;
+esac
+"""
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return round(values[min(len(values) - 1, int(len(values) * fraction))], 6)
+
+
+def summarize(values):
+    return {
+        "p50": percentile(values, 0.50),
+        "p99": percentile(values, 0.99),
+        "max": round(max(values), 6) if values else None,
+    }
+
+
+def parse_mix(mix):
+    weights = {}
+    for entry in mix.split(","):
+        name, _, weight = entry.partition("=")
+        if name not in ("deploy", "reload", "autoscaling"):
+            raise argparse.ArgumentTypeError(f"unknown request type {name}")
+        weights[name] = float(weight or 1)
+    return weights
+
+
+async def start_site(app, host, port=0):
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, host, port)
+    await site.start()
+    return runner, runner.addresses[0][1]
+
+
+def create_reload_app(latency):
+    async def reload(request):
+        await request.json()
+        if latency:
+            await asyncio.sleep(latency)
+        return web.HTTPOk()
+
+    app = web.Application()
+    app.router.add_post("/reload", reload)
+    return app
+
+
+def prepare_workdir(workdir, args, services, reload_ports):
+    """
+    Create the files nomad-service expects in its working directory.
+    """
+
+    os.makedirs(os.path.join(workdir, "local"))
+    os.makedirs(os.path.join(workdir, "bin"))
+
+    with open(os.path.join(workdir, "local", "service-keys.json"), "w") as fp:
+        json.dump({service: {"key": SERVICE_KEY} for service in services}, fp)
+    with open(os.path.join(workdir, "local", "services.json"), "w") as fp:
+        json.dump({service: [{"address": "::1", "port": port} for port in reload_ports] for service in services}, fp)
+
+    for name, template in (("aws", FAKE_AWS), ("nomad", FAKE_NOMAD)):
+        filename = os.path.join(workdir, "bin", name)
+        with open(filename, "w") as fp:
+            fp.write(template.format(latency=args.cli_latency, python=sys.executable))
+        os.chmod(filename, 0o755)
+
+    # Like Pulumi does when deploying it.
+    with open(NOMAD_SERVICE) as fp:
+        content = fp.read().replace("[[ target ]]", "aws")
+    with open(os.path.join(workdir, "nomad-service.py"), "w") as fp:
+        fp.write(content)
+
+
+def read_rss(pid):
+    """
+    Return current and peak RSS in KiB of a process.
+    """
+
+    result = {}
+    with open(f"/proc/{pid}/status") as fp:
+        for line in fp:
+            if line.startswith(("VmRSS:", "VmHWM:")):
+                name, value = line.split(":")
+                result[name] = int(value.split()[0])
+    return result.get("VmRSS"), result.get("VmHWM")
+
+
+async def run(args):
+    services = [f"service-{i}" for i in range(args.services)]
+    counter = itertools.count()
+
+    nomad = FakeNomad(args.nomad_latency)
+    for service in services:
+        nomad.add_service(service)
+
+    nomad_runner, nomad_port = await start_site(nomad.create_app(), "127.0.0.1")
+    reload_runners = []
+    reload_ports = []
+    for _ in range(args.reload_instances):
+        runner, port = await start_site(create_reload_app(args.reload_latency), "::1")
+        reload_runners.append(runner)
+        reload_ports.append(port)
+
+    workdir = tempfile.mkdtemp(prefix="nomad-service-benchmark-")
+    prepare_workdir(workdir, args, services, reload_ports)
+
+    port = free_port()
+    env = dict(os.environ)
+    env["PATH"] = f"{os.path.join(workdir, 'bin')}:{env['PATH']}"
+    env["NOMAD_ADDR"] = f"http://127.0.0.1:{nomad_port}"
+    env["DRAIN_BATCH_WINDOW"] = str(args.drain_batch_window)
+    proc = await asyncio.create_subprocess_exec(
+        sys.executable,
+        "nomad-service.py",
+        str(port),
+        cwd=workdir,
+        env=env,
+        stdout=asyncio.subprocess.DEVNULL,
+        stderr=asyncio.subprocess.DEVNULL,
+    )
+
+    base_url = f"http://127.0.0.1:{port}"
+    latencies = {name: [] for name in args.mix}
+    errors = {name: 0 for name in args.mix}
+    loop_lag = []
+    peak = {"rss": 0}
+
+    async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=0)) as session:
+        # Wait for nomad-service to come online.
+        for _ in range(100):
+            try:
+                async with session.get(f"{base_url}/healthz") as response:
+                    if response.status == 200:
+                        break
+            except aiohttp.ClientError:
+                pass
+            await asyncio.sleep(0.1)
+        else:
+            proc.kill()
+            raise RuntimeError("nomad-service did not start")
+
+        def build_request(name):
+            service = random.choice(services)
+            url = f"{base_url}/{name}/{service}/{SERVICE_KEY}"
+
+            if name == "deploy":
+                return url, {"json": {"version": f"1.0.{next(counter)}"}}
+            if name == "reload":
+                return url, {"json": {"secret": "benchmark"}}
+
+            message = {
+                "LifecycleTransition": "autoscaling:EC2_INSTANCE_TERMINATING",
+                "EC2InstanceId": f"i-{next(counter):017x}",
+                "LifecycleHookName": "benchmark",
+                "AutoScalingGroupName": service,
+            }
+            return url, {
+                "json": {"Type": "Notification", "Message": json.dumps(message)},
+                "headers": {"x-amz-sns-topic-arn": "benchmark"},
+            }
+
+        async def worker(deadline):
+            names = list(args.mix)
+            weights = [args.mix[name] for name in names]
+
+            while time.monotonic() < deadline:
+                name = random.choices(names, weights)[0]
+                url, kwargs = build_request(name)
+
+                start = time.monotonic()
+                try:
+                    async with session.post(url, **kwargs) as response:
+                        body = await response.read()
+                        if response.status != 200 or b"ERROR:" in body:
+                            errors[name] += 1
+                except aiohttp.ClientError:
+                    errors[name] += 1
+                latencies[name].append(time.monotonic() - start)
+
+        async def probe(deadline):
+            # A /healthz call does no work, so its latency shows how busy the event loop is.
+            while time.monotonic() < deadline:
+                start = time.monotonic()
+                async with session.get(f"{base_url}/healthz") as response:
+                    await response.read()
+                loop_lag.append(time.monotonic() - start)
+
+                rss, hwm = read_rss(proc.pid)
+                peak["rss"] = max(peak["rss"], hwm or rss or 0)
+
+                await asyncio.sleep(args.probe_interval)
+
+        start = time.monotonic()
+        deadline = start + args.duration
+        await asyncio.gather(probe(deadline), *[worker(deadline) for _ in range(args.concurrency)])
+        elapsed = time.monotonic() - start
+
+    proc.terminate()
+    await proc.wait()
+    shutil.rmtree(workdir)
+
+    await nomad_runner.cleanup()
+    for runner in reload_runners:
+        await runner.cleanup()
+
+    total = sum(len(values) for values in latencies.values())
+    return {
+        "config": {
+            "duration": args.duration,
+            "concurrency": args.concurrency,
+            "mix": args.mix,
+            "services": args.services,
+            "reload_instances": args.reload_instances,
+            "nomad_latency": args.nomad_latency,
+            "cli_latency": args.cli_latency,
+            "reload_latency": args.reload_latency,
+        },
+        "elapsed": round(elapsed, 3),
+        "throughput": round(total / elapsed, 3),
+        "requests": {
+            name: {
+                "count": len(latencies[name]),
+                "errors": errors[name],
+                "throughput": round(len(latencies[name]) / elapsed, 3),
+                "latency": summarize(latencies[name]),
+            }
+            for name in args.mix
+        },
+        "loop_lag": summarize(loop_lag),
+        "peak_rss_kib": peak["rss"],
+        "nomad_api_requests": nomad.requests,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load-test nomad-service.")
+    parser.add_argument("--duration", type=float, default=10, help="seconds to generate load for")
+    parser.add_argument("--concurrency", type=int, default=10, help="number of parallel clients")
+    parser.add_argument(
+        "--mix", type=parse_mix, default="deploy=1,reload=1,autoscaling=1", help="weights per request type"
+    )
+    parser.add_argument("--services", type=int, default=4, help="number of services to spread requests over")
+    parser.add_argument("--reload-instances", type=int, default=3, help="number of reloadable instances per service")
+    parser.add_argument("--nomad-latency", type=float, default=0.005, help="latency of every fake Nomad API call")
+    parser.add_argument("--cli-latency", type=float, default=0.05, help="latency of every fake nomad/aws execution")
+    parser.add_argument("--reload-latency", type=float, default=0.01, help="latency of every /reload call")
+    parser.add_argument("--drain-batch-window", type=float, default=0.5, help="DRAIN_BATCH_WINDOW for nomad-service")
+    parser.add_argument("--probe-interval", type=float, default=0.1, help="interval between event-loop lag probes")
+    parser.add_argument("--output", help="write the JSON result to this file instead of stdout")
+    args = parser.parse_args()
+
+    result = asyncio.run(run(args))
+
+    if args.output:
+        with open(args.output, "w") as fp:
+            json.dump(result, fp, indent=2)
+    else:
+        print(json.dumps(result, indent=2))
+
+
+if __name__ == "__main__":
+    main()
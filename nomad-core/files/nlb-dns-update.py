@@ -6,198 +6,621 @@
 
 import aiohttp
 import asyncio
+import hashlib
 import json
 import logging
+import os
 import shlex
 import signal
+import time
 
-NLB = []
-TASK = None
+NLB_FILE = "local/nlb.json"
+NLB_WATCH_INTERVAL = 5
+NLB = ()
+NLB_DIGEST = None
 LOOP = None
 
+# Changes arriving within this many seconds of each other are handled by a single update.
+RECONCILE_DEBOUNCE = float(os.getenv("RECONCILE_DEBOUNCE", "2"))
+# After a failed update, wait this many seconds before trying again.
+RECONCILE_RETRY = float(os.getenv("RECONCILE_RETRY", "30"))
+RECONCILER = None
+
+CLOUDFLARE_API = "https://api.cloudflare.com/client/v4/zones/[[ cloudflare_zone_id ]]/dns_records"
+CLOUDFLARE_HEADERS = {
+    "Content-Type": "application/json",
+    "Authorization": "Bearer [[ cloudflare_api_token ]]",
+}
+CLOUDFLARE_CONCURRENCY = int(os.getenv("CLOUDFLARE_CONCURRENCY", "4"))
+# Use the batch endpoint, till Cloudflare tells it is not there.
+CLOUDFLARE_BATCH = os.getenv("CLOUDFLARE_BATCH", "1") == "1"
+SESSION = None
+
+# The records as they were last applied, per domain; only trusted once they are checked against Cloudflare.
+SNAPSHOT_FILE = "local/nlb-dns-snapshot.json"
+SNAPSHOT = None
+
+# How long the public addresses of an instance are trusted, before asking the cloud again.
+INVENTORY_TTL = int(os.getenv("INVENTORY_TTL", "600"))
+INVENTORY = None
+
+# Probe every NLB this often (in seconds) and only publish the ones that answer; 0 disables probing.
+HEALTH_CHECK_INTERVAL = float(os.getenv("HEALTH_CHECK_INTERVAL", "0"))
+HEALTH_CHECK_TIMEOUT = float(os.getenv("HEALTH_CHECK_TIMEOUT", "2"))
+HEALTH_CHECK_PATH = "/healthz"
+# Consecutive failures before an NLB is withdrawn, and consecutive passes before it is published again.
+HEALTH_CHECK_FALL = int(os.getenv("HEALTH_CHECK_FALL", "1"))
+HEALTH_CHECK_RISE = int(os.getenv("HEALTH_CHECK_RISE", "3"))
+HEALTH = None
+
 log = logging.getLogger(__name__)
 
 
-async def update_dns(domain, ips):
-    # First request all current entries (so we can remove them).
-    async with aiohttp.ClientSession() as session:
-        response = await session.get(
-            f"https://api.cloudflare.com/client/v4/zones/[[ cloudflare_zone_id ]]/dns_records",
-            params={"name": domain},
-            headers={
-                "Content-Type": "application/json",
-                "Authorization": "Bearer [[ cloudflare_api_token ]]",
-            },
-            raise_for_status=True,
-        )
+async def get_records(domain):
+    async with SESSION.get(
+        CLOUDFLARE_API, params={"name": domain, "per_page": 100}, headers=CLOUDFLARE_HEADERS, raise_for_status=True
+    ) as response:
         payload = await response.json()
+    return payload["result"]
 
-        # Check what IPs need to be added and which to be removed.
-        for record in payload["result"]:
-            # The record is already there.
-            if (record["type"], record["content"]) in ips:
-                ips.remove((record["type"], record["content"]))
-                continue
 
-            # The record is not there, remove it.
-            log.info(f"Removing {record['type']} record {record['content']} ...")
-            await session.delete(
-                f"https://api.cloudflare.com/client/v4/zones/[[ cloudflare_zone_id ]]/dns_records/{record['id']}",
-                headers={
-                    "Content-Type": "application/json",
-                    "Authorization": "Bearer [[ cloudflare_api_token ]]",
-                },
-                raise_for_status=True,
-            )
-
-        # Add all the remaining records.
-        for ip in ips:
-            log.info(f"Adding {ip[0]} record {ip[1]} ...")
-            await session.post(
-                f"https://api.cloudflare.com/client/v4/zones/[[ cloudflare_zone_id ]]/dns_records",
-                json={
-                    "type": ip[0],
-                    "name": domain,
-                    "content": ip[1],
-                    "ttl": 60,
-                    "proxied": False,
-                },
-                headers={
-                    "Content-Type": "application/json",
-                    "Authorization": "Bearer [[ cloudflare_api_token ]]",
-                },
-                raise_for_status=True,
-            )
+def diff_records(domain, records, ips):
+    """
+    Return the records to create and the records to delete to go from "records" to "ips".
+    """
 
+    missing = dict.fromkeys(ips)
+    deletes = []
+    for record in records:
+        # The record is already there.
+        if (record["type"], record["content"]) in missing:
+            del missing[(record["type"], record["content"])]
+            continue
 
-async def update_nlb_dns():
-    log.info("NLB configuration changed, updating DNS ...")
+        # The record should not be there (or is a duplicate); remove it.
+        deletes.append(record)
+
+    creates = [
+        {"type": type, "name": domain, "content": content, "ttl": 60, "proxied": False} for type, content in missing
+    ]
+    return creates, deletes
+
+
+async def apply_batch(creates, deletes):
+    """
+    Apply all changes in a single call; returns False if the batch endpoint is not available.
+    """
+
+    global CLOUDFLARE_BATCH
+
+    async with SESSION.post(
+        f"{CLOUDFLARE_API}/batch",
+        json={"deletes": [{"id": record["id"]} for record in deletes], "posts": creates},
+        headers=CLOUDFLARE_HEADERS,
+    ) as response:
+        if response.status in (404, 405, 501):
+            log.warning("Batch DNS endpoint not available; falling back to one call per record.")
+            CLOUDFLARE_BATCH = False
+            return False
+        response.raise_for_status()
+
+    return True
+
+
+async def apply_one_by_one(creates, deletes):
+    semaphore = asyncio.Semaphore(CLOUDFLARE_CONCURRENCY)
+
+    async def call(method, url, **kwargs):
+        async with semaphore:
+            async with SESSION.request(method, url, headers=CLOUDFLARE_HEADERS, raise_for_status=True, **kwargs):
+                pass
+
+    # Creates go first, so during the update the round-robin set only grows.
+    await asyncio.gather(*[call("POST", CLOUDFLARE_API, json=record) for record in creates])
+    await asyncio.gather(*[call("DELETE", f"{CLOUDFLARE_API}/{record['id']}") for record in deletes])
+
+
+def load_snapshot():
+    """
+    Read the snapshot of the records last applied.
+
+    This is blocking, so it is meant to be run in an executor.
+    """
+
+    with open(SNAPSHOT_FILE) as fp:
+        snapshot = json.load(fp)
+
+    return {domain: [tuple(ip) for ip in ips] for domain, ips in snapshot.items()}
+
+
+def save_snapshot(snapshot):
+    """
+    Write the snapshot of the records last applied; the file is replaced as a whole, so it is never half-written.
+
+    This is blocking, so it is meant to be run in an executor.
+    """
+
+    with open(f"{SNAPSHOT_FILE}.tmp", "w") as fp:
+        json.dump(snapshot, fp)
+    os.replace(f"{SNAPSHOT_FILE}.tmp", SNAPSHOT_FILE)
+
+
+async def verify_snapshot():
+    """
+    Load the snapshot left behind by a previous run, and only trust it if Cloudflare still agrees with it.
+    """
+
+    global SNAPSHOT
+
+    try:
+        snapshot = await LOOP.run_in_executor(None, load_snapshot)
+    except FileNotFoundError:
+        return
+    except Exception:
+        log.exception("Failed to load snapshot.")
+        return
+
+    domains = list(snapshot)
+    current = await asyncio.gather(*[get_records(domain) for domain in domains])
+    for domain, records in zip(domains, current):
+        creates, deletes = diff_records(domain, records, snapshot[domain])
+        if creates or deletes:
+            log.warning(f"Records of {domain} no longer match the snapshot; ignoring the snapshot.")
+            return
+
+    log.info("Snapshot matches the records in Cloudflare.")
+    SNAPSHOT = snapshot
+
+
+async def update_dns(desired):
+    """
+    Make the records of every domain in "desired" match the (type, content) pairs given for it.
+
+    Nothing is requested from Cloudflare if this is what was applied last.
+    """
+
+    global SNAPSHOT
+
+    # Order and duplicates don't matter for DNS, so don't let them count as a change either.
+    desired = {domain: sorted(set(ips)) for domain, ips in desired.items()}
+    if desired == SNAPSHOT:
+        log.info("Records are unchanged since the last update; nothing to do.")
+        return
+
+    # From here on, Cloudflare might end up anywhere between the old and the new records.
+    SNAPSHOT = None
+
+    # First request all current entries of all domains, so the full diff is known before changing anything.
+    domains = list(desired)
+    current = await asyncio.gather(*[get_records(domain) for domain in domains])
+
+    creates = []
+    deletes = []
+    for domain, records in zip(domains, current):
+        domain_creates, domain_deletes = diff_records(domain, records, desired[domain])
+        creates.extend(domain_creates)
+        deletes.extend(domain_deletes)
+
+    for record in creates:
+        log.info(f"Adding {record['type']} record {record['content']} to {record['name']} ...")
+    for record in deletes:
+        log.info(f"Removing {record['type']} record {record['content']} from {record['name']} ...")
+
+    if creates or deletes:
+        # A batch is applied by Cloudflare as a whole, so the record set is never half-updated.
+        if not CLOUDFLARE_BATCH or not await apply_batch(creates, deletes):
+            await apply_one_by_one(creates, deletes)
+
+    SNAPSHOT = desired
+    try:
+        await LOOP.run_in_executor(None, save_snapshot, desired)
+    except Exception:
+        log.exception("Failed to save snapshot.")
+
+
+async def describe_instances(private_ips):
+    """
+    Ask the cloud for the public addresses of instances, as {private IP: (public IPv4, public IPv6)}.
+
+    On AWS only the instances with the given private IPs are described. OCI
+    has no such filter, so there all instances of the pool are returned.
+    Returns None on failure.
+    """
 
     if "[[ target ]]" == "aws":
         proc = await asyncio.create_subprocess_exec(
             "aws",
-            *shlex.split(
-                "--region eu-west-1 ec2 describe-instances --query 'Reservations[].Instances[].{private:PrivateIpAddress,public_v4:PublicIpAddress,public_v6:NetworkInterfaces[0].Ipv6Prefixes[0].Ipv6Prefix}'"
-            ),
+            *shlex.split("--region eu-west-1 ec2 describe-instances"),
+            "--filters",
+            f"Name=private-ip-address,Values={','.join(private_ips)}",
+            "--query",
+            "Reservations[].Instances[].{private:PrivateIpAddress,public_v4:PublicIpAddress,public_v6:NetworkInterfaces[0].Ipv6Prefixes[0].Ipv6Prefix}",
             stdout=asyncio.subprocess.PIPE,
         )
-        if await proc.wait() != 0:
-            log.warning("Failed to get IP mapping")
-            return
-
-        ip_mapping = json.loads(await proc.stdout.read())
-
-        # Map the private IP addresses to the public IP addresses.
-        ips = []
-        for nlb in NLB:
-            if not nlb:
-                continue
-
-            for ip_map in ip_mapping:
-                if ip_map["private"] == nlb:
-                    ips.append(("A", ip_map["public_v4"]))
-                    ips.append(("AAAA", ip_map["public_v6"].replace("::/80", "::1")))
-                    break
-            else:
-                log.warning(f"Could not find public IP for NLB {nlb}")
+        stdout, _ = await proc.communicate()
+        if proc.returncode != 0:
+            return None
+
+        return {
+            ip_map["private"]: (ip_map["public_v4"], ip_map["public_v6"].replace("::/80", "::1"))
+            for ip_map in json.loads(stdout)
+        }
     elif "[[ target ]]" == "oci":
         proc = await asyncio.create_subprocess_exec(
             "oci-list-pool-ips.sh",
             *shlex.split("all nomad-public"),
             stdout=asyncio.subprocess.PIPE,
         )
-        if await proc.wait() != 0:
-            log.warning("Failed to get IP mapping")
+        stdout, _ = await proc.communicate()
+        if proc.returncode != 0:
+            return None
+
+        return {
+            ip_map["private-ip"]: (ip_map["public-ip"], ip_map["ipv6-addresses"][0]) for ip_map in json.loads(stdout)
+        }
+    else:
+        log.warning("Unknown target")
+        return None
+
+
+class Inventory:
+    """
+    Public addresses of instances, indexed by their private IP.
+
+    Addresses are kept for a TTL; a lookup only asks the cloud about the
+    private IPs that are unknown or expired, so repeated updates for the
+    same set of NLBs are answered from memory.
+    """
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._entries = {}
+
+    async def lookup(self, private_ips):
+        """
+        Return {private IP: (public IPv4, public IPv6)} for the given private IPs; None if the cloud couldn't be asked.
+
+        Private IPs the cloud doesn't know about are left out.
+        """
+
+        now = time.monotonic()
+        missing = [ip for ip in private_ips if ip not in self._entries or self._entries[ip][0] < now]
+
+        if missing:
+            mapping = await describe_instances(missing)
+            if mapping is None:
+                return None
+
+            for private_ip, public_ips in mapping.items():
+                self._entries[private_ip] = (now + self.ttl, public_ips)
+
+        return {ip: self._entries[ip][1] for ip in private_ips if ip in self._entries}
+
+    def invalidate(self, private_ips=None):
+        """
+        Forget the given private IPs, or everything if none are given.
+        """
+
+        if private_ips is None:
+            self._entries.clear()
             return
 
-        ip_mapping = json.loads(await proc.stdout.read())
+        for ip in private_ips:
+            self._entries.pop(ip, None)
 
-        # Map the private IP addresses to the public IP addresses.
-        ips = []
-        for nlb in NLB:
-            if not nlb:
-                continue
 
-            for ip_map in ip_mapping:
-                if ip_map["private-ip"] == nlb:
-                    ips.append(("A", ip_map["public-ip"]))
-                    ips.append(("AAAA", ip_map["ipv6-addresses"][0]))
-                    break
-            else:
-                log.warning(f"Could not find public IP for NLB {nlb}")
-    else:
-        log.warning("Unknown target")
-        return
+async def update_nlb_dns():
+    """
+    Make DNS match the current list of NLBs; returns False if that didn't work out.
+    """
+
+    log.info("NLB configuration changed, updating DNS ...")
+
+    # NLB can be replaced while this runs; work with the list as it was at the start.
+    nlbs = NLB
+    if HEALTH:
+        nlbs = HEALTH.filter(nlbs)
+
+    mapping = await INVENTORY.lookup(nlbs)
+    if mapping is None:
+        log.warning("Failed to get IP mapping")
+        return False
+
+    # Map the private IP addresses to the public IP addresses.
+    ips = []
+    for nlb in nlbs:
+        if nlb not in mapping:
+            log.warning(f"Could not find public IP for NLB {nlb}")
+            continue
+
+        public_v4, public_v6 = mapping[nlb]
+        ips.append(("A", public_v4))
+        ips.append(("AAAA", public_v6))
 
     log.info(f"Public IPs detected:")
     for ip in ips:
         log.info(f"  {ip[1]}")
     log.info("")
 
-    await update_dns("nlb-[[ target ]].openttd.org", ips)
-
     # Also create a DNS entry for the internal IP addresses. This is not ideal,
     # as you tell the outside world what your internal IP addresses are, but it
     # is by far the simplest way to get a round-robin DNS for the internal
     # services.
-    ips = []
-    for nlb in NLB:
-        if not nlb:
-            continue
-
-        ips.append(("A", nlb))
+    internal_ips = []
+    for nlb in nlbs:
+        internal_ips.append(("A", nlb))
 
     log.info(f"Internal IPs detected:")
-    for ip in ips:
+    for ip in internal_ips:
         log.info(f"  {ip[1]}")
     log.info("")
 
-    await update_dns("nlb-[[ target ]]-internal.openttd.org", ips)
+    await update_dns(
+        {
+            "nlb-[[ target ]].openttd.org": ips,
+            "nlb-[[ target ]]-internal.openttd.org": internal_ips,
+        }
+    )
 
     log.info("DNS updated.")
-    global TASK
-    TASK = None
+    return True
 
 
-async def update_nlb_dns_wrapper():
+async def probe(session, host):
     try:
-        await update_nlb_dns()
-    except Exception:
-        log.exception("Failed to update NLB DNS.")
+        async with session.get(f"http://{host}{HEALTH_CHECK_PATH}") as response:
+            return response.status == 200
+    except (aiohttp.ClientError, asyncio.TimeoutError):
+        return False
+
+
+class HealthProber:
+    """
+    Probes the NLBs, and tracks which of them are serving.
+
+    Every round, the health endpoint of nginx is requested on the internal
+    address and the public addresses of all NLBs at once; an NLB passes if
+    all of them answer. An NLB is withdrawn from DNS (public and internal)
+    after HEALTH_CHECK_FALL failed rounds, and only comes back after
+    HEALTH_CHECK_RISE passed rounds, so a flaky NLB doesn't flap in and out.
+    NLBs that were never probed count as healthy.
+    """
+
+    def __init__(self, interval):
+        self.interval = interval
+        # Per private IP: whether it is healthy, and for how many rounds it has been saying otherwise.
+        self._state = {}
+
+    def filter(self, nlbs):
+        """
+        Return the NLBs that are healthy.
+
+        If none of them are, something is more likely wrong with the probing
+        than with all NLBs; then all are returned, rather than none.
+        """
+
+        healthy = tuple(nlb for nlb in nlbs if self._state.get(nlb, (True, 0))[0])
+        if nlbs and not healthy:
+            log.warning("All NLBs are failing their health check; publishing them anyway.")
+            return nlbs
+        return healthy
+
+    def _record(self, nlb, passed):
+        """
+        Record the outcome of a probe; returns True if the NLB changed between healthy and unhealthy.
+        """
+
+        healthy, count = self._state.get(nlb, (True, 0))
+        if passed == healthy:
+            self._state[nlb] = (healthy, 0)
+            return False
+
+        count += 1
+        if count < (HEALTH_CHECK_FALL if healthy else HEALTH_CHECK_RISE):
+            self._state[nlb] = (healthy, count)
+            return False
+
+        if healthy:
+            log.warning(f"NLB {nlb} is failing its health check; withdrawing it ...")
+        else:
+            log.info(f"NLB {nlb} is passing its health check again; publishing it ...")
+        self._state[nlb] = (passed, 0)
+        return True
+
+    async def _round(self, session):
+        nlbs = NLB
+
+        mapping = await INVENTORY.lookup(nlbs)
+        if mapping is None:
+            log.warning("Failed to get IP mapping; skipping health check")
+            return
+
+        async def check(nlb):
+            hosts = [nlb]
+            if nlb in mapping:
+                public_v4, public_v6 = mapping[nlb]
+                hosts.extend([public_v4, f"[{public_v6}]"])
+
+            return all(await asyncio.gather(*[probe(session, host) for host in hosts]))
 
+        passed = await asyncio.gather(*[check(nlb) for nlb in nlbs])
 
-def update_nlb_dns_trigger():
-    global TASK
+        changed = False
+        for nlb, result in zip(nlbs, passed):
+            changed |= self._record(nlb, result)
 
-    if TASK:
-        log.info("Cancelling update; newer update found.")
-        TASK.cancel()
+        for nlb in set(self._state) - set(nlbs):
+            del self._state[nlb]
 
-    TASK = LOOP.create_task(update_nlb_dns_wrapper())
+        if changed:
+            RECONCILER.trigger()
 
+    async def run(self):
+        # Every probe uses a new connection, as that is what a client resolving the record does too.
+        async with aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(force_close=True),
+            timeout=aiohttp.ClientTimeout(total=HEALTH_CHECK_TIMEOUT),
+        ) as session:
+            while True:
+                await asyncio.sleep(self.interval)
+
+                try:
+                    await self._round(session)
+                except Exception:
+                    log.exception("Failed to check health of NLBs.")
+
+
+class Reconciler:
+    """
+    Runs update_nlb_dns() whenever something changed, one at a time.
+
+    An update is never cancelled halfway, as that could leave DNS with only
+    part of the records. Instead, triggers arriving within RECONCILE_DEBOUNCE
+    seconds are folded into one update, and triggers arriving while an update
+    runs make it run once more afterwards, against the newest state. A failed
+    update is retried after RECONCILE_RETRY seconds.
+    """
+
+    def __init__(self):
+        self._dirty = asyncio.Event()
+        self.triggers = 0
+        self.coalesced = 0
+        self.reconciliations = 0
+
+    def trigger(self):
+        self.triggers += 1
+
+        # An update is already pending; it will pick up this change too.
+        if self._dirty.is_set():
+            self.coalesced += 1
+            return
+
+        self._dirty.set()
+
+    async def run(self):
+        try:
+            await verify_snapshot()
+        except Exception:
+            log.exception("Failed to verify snapshot.")
+
+        while True:
+            await self._dirty.wait()
+            await asyncio.sleep(RECONCILE_DEBOUNCE)
+            self._dirty.clear()
+
+            try:
+                success = await update_nlb_dns()
+            except Exception:
+                log.exception("Failed to update NLB DNS.")
+                success = False
+
+            if not success:
+                LOOP.call_later(RECONCILE_RETRY, self.trigger)
+                continue
+
+            self.reconciliations += 1
+            log.info(f"Reconciliations: {self.reconciliations}; triggers: {self.triggers} ({self.coalesced} coalesced)")
+
+
+async def open_session():
+    """
+    Open the session used for all calls to Cloudflare, so connections are kept alive between calls and updates.
+    """
+
+    global SESSION
+
+    SESSION = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=CLOUDFLARE_CONCURRENCY))
+
+
+def load_nlb(digest=None):
+    """
+    Read and parse nlb.json; returns None if it didn't change since "digest".
+
+    This is blocking, so it is meant to be run in an executor.
+    """
+
+    with open(NLB_FILE, "rb") as fp:
+        content = fp.read()
+
+    new_digest = hashlib.sha256(content).hexdigest()
+    if new_digest == digest:
+        return None
+
+    return tuple(nlb for nlb in json.loads(content) if nlb), new_digest
+
+
+async def reload_nlb():
+    global NLB, NLB_DIGEST
 
-def handle_sighup(*args):
     log.info("Reloading files ...")
-    global NLB
 
-    nlb = json.loads(open("local/nlb.json").read())
+    try:
+        result = await LOOP.run_in_executor(None, load_nlb, NLB_DIGEST)
+    except Exception:
+        log.exception("Failed to reload files.")
+        return
 
+    if result is None:
+        return
+
+    nlb, NLB_DIGEST = result
     if nlb != NLB:
+        # An instance that left could come back with the same private IP but
+        # as a new instance, with other public IPs; so don't remember it.
+        INVENTORY.invalidate(set(NLB) - set(nlb))
+
         NLB = nlb
-        LOOP.call_soon_threadsafe(update_nlb_dns_trigger)
+        RECONCILER.trigger()
+
+
+async def watch_nlb():
+    last_stat = None
+
+    while True:
+        await asyncio.sleep(NLB_WATCH_INTERVAL)
+
+        try:
+            stat = os.stat(NLB_FILE)
+        except OSError:
+            continue
+
+        stat = (stat.st_mtime_ns, stat.st_size)
+        if last_stat is not None and stat != last_stat:
+            await reload_nlb()
+        last_stat = stat
+
+
+def refresh_inventory():
+    log.info("Forgetting all known instances ...")
+    INVENTORY.invalidate()
+    RECONCILER.trigger()
 
 
 def main():
-    global LOOP
+    global LOOP, INVENTORY, RECONCILER, HEALTH
 
     logging.basicConfig(
         format="%(asctime)s %(levelname)-8s [%(name)s] %(message)s", datefmt="%Y-%m-%d %H:%M:%S", level=logging.INFO
     )
 
     LOOP = asyncio.new_event_loop()
-
-    handle_sighup()
-    signal.signal(signal.SIGHUP, handle_sighup)
+    # The reconciler creates its primitives outside of a coroutine; make sure they end up on this loop.
+    asyncio.set_event_loop(LOOP)
+    LOOP.run_until_complete(open_session())
+
+    INVENTORY = Inventory(INVENTORY_TTL)
+    RECONCILER = Reconciler()
+
+    LOOP.add_signal_handler(signal.SIGHUP, lambda: LOOP.create_task(reload_nlb()))
+    # Send SIGUSR1 when instances changed their public IPs, to look them up again.
+    LOOP.add_signal_handler(signal.SIGUSR1, refresh_inventory)
+    LOOP.create_task(reload_nlb())
+    LOOP.create_task(watch_nlb())
+    LOOP.create_task(RECONCILER.run())
+
+    if HEALTH_CHECK_INTERVAL:
+        HEALTH = HealthProber(HEALTH_CHECK_INTERVAL)
+        LOOP.create_task(HEALTH.run())
 
     LOOP.run_forever()
 
@@ -9,71 +9,641 @@ This proxy listens on 8686, and forwards all requests to 127.0.0.1:4646.
 """
 
 import aiohttp
+import asyncio
+import collections
+import json
+import logging
+import os
+import re
+import time
+import zlib
 
 from aiohttp import web
+from aiohttp.web_log import AccessLogger
 
 routes = web.RouteTableDef()
 
-EVENT_STREAM_URLS = [
-    "v1/event/stream",
-    "v1/client/fs/logs/",
+REMOTE_IP_HEADER = "cf-connecting-ip"
+
+UPSTREAM = os.getenv("NOMAD_PROXY_UPSTREAM", "http://127.0.0.1:4646")
+PORT = int(os.getenv("NOMAD_PROXY_PORT", "8686"))
+POOL_LIMIT = int(os.getenv("POOL_LIMIT", "100"))
+KEEPALIVE_TIMEOUT = float(os.getenv("KEEPALIVE_TIMEOUT", "60"))
+CONNECT_TIMEOUT = float(os.getenv("CONNECT_TIMEOUT", "10"))
+CACHE_TTL = float(os.getenv("CACHE_TTL", "2"))
+# This proxy runs with little memory; only small responses are worth sharing anyway.
+CACHE_MAX_SIZE = int(os.getenv("CACHE_MAX_SIZE", str(4 * 1024 * 1024)))
+CACHE_ENTRY_MAX_SIZE = int(os.getenv("CACHE_ENTRY_MAX_SIZE", str(128 * 1024)))
+SESSION = None
+CACHE = None
+INFLIGHT = {}
+
+
+class Metric:
+    """
+    Minimal Prometheus metric; the node only has aiohttp installed, so no prometheus_client.
+    """
+
+    TYPE = None
+
+    def __init__(self, name, documentation, labelnames):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._values = {}
+
+        METRICS.append(self)
+
+    def _key(self, labels):
+        return tuple(labels[name] for name in self.labelnames)
+
+    def _format_labels(self, key, extra=None):
+        labels = [f'{name}="{value}"' for name, value in zip(self.labelnames, key)]
+        if extra:
+            labels.append(extra)
+        return "{" + ",".join(labels) + "}" if labels else ""
+
+    def expose(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.TYPE}"]
+        for key, value in sorted(self._values.items()):
+            lines.append(f"{self.name}{self._format_labels(key)} {value}")
+        return lines
+
+
+class Counter(Metric):
+    TYPE = "counter"
+
+    def inc(self, value=1, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + value
+
+
+class Gauge(Metric):
+    TYPE = "gauge"
+
+    def inc(self, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + 1
+
+    def dec(self, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) - 1
+
+
+class Histogram(Metric):
+    TYPE = "histogram"
+    # Blocking queries wait up to 5 minutes, so go well beyond that.
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        if key not in self._values:
+            self._values[key] = [[0] * len(self.BUCKETS), 0.0, 0]
+
+        buckets, _, _ = self._values[key]
+        for i, bucket in enumerate(self.BUCKETS):
+            if value <= bucket:
+                buckets[i] += 1
+        self._values[key][1] += value
+        self._values[key][2] += 1
+
+    def expose(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.TYPE}"]
+        for key, (buckets, total, count) in sorted(self._values.items()):
+            for bucket, value in zip(self.BUCKETS, buckets):
+                le = f'le="{bucket}"'
+                lines.append(f"{self.name}_bucket{self._format_labels(key, le)} {value}")
+            le = 'le="+Inf"'
+            lines.append(f"{self.name}_bucket{self._format_labels(key, le)} {count}")
+            lines.append(f"{self.name}_sum{self._format_labels(key)} {total}")
+            lines.append(f"{self.name}_count{self._format_labels(key)} {count}")
+        return lines
+
+
+METRICS = []
+REQUEST_DURATION = Histogram(
+    "nomad_proxy_request_duration_seconds", "Duration of a request, till the last byte.", ("endpoint", "method")
+)
+TIME_TO_FIRST_BYTE = Histogram(
+    "nomad_proxy_time_to_first_byte_seconds", "Time till the response headers are sent.", ("endpoint", "method")
+)
+REQUEST_BYTES = Counter("nomad_proxy_request_bytes_total", "Bytes received from clients.", ("endpoint",))
+RESPONSE_BYTES = Counter("nomad_proxy_response_bytes_total", "Bytes sent to clients, headers included.", ("endpoint",))
+OPEN_STREAMS = Gauge("nomad_proxy_open_streams", "Number of responses and WebSockets being relayed.", ("endpoint",))
+STREAMED_BYTES = Counter(
+    "nomad_proxy_streamed_bytes_total", "Bytes relayed to clients, counted as they are sent.", ("endpoint",)
+)
+CACHE_REQUESTS = Counter("nomad_proxy_cache_requests_total", "GET requests by how they were answered.", ("result",))
+
+# Paths are reduced to the endpoint they call, so metrics don't get a series per job or allocation.
+ENDPOINT_PATTERNS = [
+    (re.compile(r"^v1/client/fs/(\w+)/[^/]+"), r"/v1/client/fs/\1/:alloc"),
+    (re.compile(r"^v1/client/allocation/[^/]+/(\w+)"), r"/v1/client/allocation/:alloc/\1"),
+    (re.compile(r"^v1/var/"), "/v1/var/:path"),
+    (
+        re.compile(r"^v1/(job|allocation|node|evaluation|deployment|namespace|volume/csi|acl/token|acl/policy)/[^/]+"),
+        r"/v1/\1/:id",
+    ),
+    (re.compile(r"^ui(/|$)"), "/ui"),
+    (re.compile(r"^v1(/[\w-]+){1,3}"), r"/\g<0>"),
+]
+
+# How a response is relayed depends on the endpoint:
+#  - event_stream: mark it as text/event-stream, so cloudflared doesn't buffer it.
+#  - cacheable: GETs can be coalesced and cached.
+#  - flush: send an empty frame right after the headers, so the stream is
+#    visibly open on the other side of the tunnel before Nomad has anything to say.
+#  - heartbeat: send an empty frame when Nomad was quiet for this many seconds;
+#    Cloudflare drops connections that are idle for 100 seconds.
+#  - idle_timeout: end the response when Nomad was quiet for this many seconds.
+EndpointClass = collections.namedtuple(
+    "EndpointClass", ["event_stream", "cacheable", "flush", "heartbeat", "idle_timeout"]
+)
+
+# The first pattern that matches the path wins; anything else gets DEFAULT_CLASS.
+ENDPOINT_CLASSES = [
+    # Nomad sends a heartbeat every 10 seconds on this stream itself; ours is only a fallback.
+    ("events", r"v1/event/stream$", EndpointClass(True, False, True, 30, None)),
+    # Following a file, logs or the agent's own log; a quiet task can keep these idle for a long time.
+    ("follow", r"v1/client/fs/(?:stream|logs)/|v1/agent/monitor$", EndpointClass(True, False, True, 30, 3600)),
+    # The listings every UI and CLI polls; only these are worth sharing between clients.
+    ("lists", r"v1/(?:jobs|nodes|allocations)$", EndpointClass(False, True, False, None, None)),
 ]
+DEFAULT_CLASS = EndpointClass(False, False, False, None, None)
+
+ENDPOINT_CLASSIFIER = re.compile("|".join(f"(?P<{name}>{pattern})" for name, pattern, _ in ENDPOINT_CLASSES))
+ENDPOINT_CLASS_BY_NAME = {name: endpoint_class for name, _, endpoint_class in ENDPOINT_CLASSES}
+
+# Nomad's own heartbeat on its JSON streams: a frame without any content.
+HEARTBEAT = b"{}\n"
+# Headers that only make sense for a single connection, so are never passed on or replayed from the cache.
+HOP_BY_HOP_HEADERS = {"connection", "keep-alive", "transfer-encoding", "content-length"}
+
+CachedResponse = collections.namedtuple("CachedResponse", ["status", "headers", "body", "index"])
+
+
+class ResponseCache:
+    """
+    LRU cache of complete responses, bounded by the total size of their bodies.
+
+    Entries expire after a short TTL, as this is only meant to absorb the
+    polling of several clients looking at the same thing.
+    """
+
+    def __init__(self, ttl, max_size):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.size = 0
+        self._entries = collections.OrderedDict()
+
+    def get(self, key, index):
+        if key not in self._entries:
+            return None
+
+        expires, response = self._entries[key]
+        if expires < time.monotonic():
+            self._remove(key)
+            return None
+        # Nomad answers a blocking query right away if it has a newer index
+        # than asked for; in that case the cached response is just as good.
+        if index is not None and response.index <= index:
+            return None
+
+        self._entries.move_to_end(key)
+        return response
+
+    def put(self, key, response):
+        if len(response.body) > self.max_size:
+            return
+
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = (time.monotonic() + self.ttl, response)
+        self.size += len(response.body)
+
+        while self.size > self.max_size:
+            self._remove(next(iter(self._entries)))
+
+    def clear(self):
+        self._entries.clear()
+        self.size = 0
+
+    def _remove(self, key):
+        _, response = self._entries.pop(key)
+        self.size -= len(response.body)
+
+
+def classify(tail):
+    match = ENDPOINT_CLASSIFIER.match(tail)
+    if match is None:
+        return DEFAULT_CLASS
+    return ENDPOINT_CLASS_BY_NAME[match.lastgroup]
+
+
+async def read_limited(proxy_response):
+    """
+    Read a response from Nomad if it is no bigger than CACHE_ENTRY_MAX_SIZE.
+
+    Returns the body, or None and the chunks read so far if it turned out bigger.
+    """
+
+    if proxy_response.content_length is not None and proxy_response.content_length > CACHE_ENTRY_MAX_SIZE:
+        return None, []
+
+    chunks = []
+    size = 0
+    async for chunk in proxy_response.content.iter_any():
+        chunks.append(chunk)
+        size += len(chunk)
+        if size > CACHE_ENTRY_MAX_SIZE:
+            return None, chunks
+
+    return b"".join(chunks), None
+
+
+def to_cached_response(proxy_response, body):
+    response_headers = [
+        (name, value) for name, value in proxy_response.headers.items() if name.lower() not in HOP_BY_HOP_HEADERS
+    ]
+    index = proxy_response.headers.get("X-Nomad-Index")
+    index = int(index) if index and index.isdigit() else None
+
+    # See proxy() why blocking queries are marked as streaming.
+    if index is not None:
+        response_headers = [(name, value) for name, value in response_headers if name.lower() != "content-type"]
+        response_headers.append(("Content-Type", "text/event-stream"))
+
+    return CachedResponse(proxy_response.status, response_headers, body, index)
+
+
+def from_cached_response(response, status):
+    result = web.Response(status=response.status, body=response.body, headers=response.headers)
+    result.headers["X-Nomad-Proxy-Cache"] = status
+    return result
+
+
+async def proxy_cached(request, url, headers, endpoint_class, start):
+    """
+    Answer a GET from the cache, or by joining an identical request already in flight.
+
+    Only responses up to CACHE_ENTRY_MAX_SIZE are shared; bigger ones are
+    streamed to the client that asked for them, while the clients that
+    joined it make their own request. Returns None if the caller has to
+    do that request.
+    """
+
+    tail = request.match_info["tail"]
+    # Responses depend on who is asking, so never share them between tokens.
+    credentials = (request.headers.get("X-Nomad-Token"), request.headers.get("Authorization"))
+    # Bodies are kept as Nomad sent them, so they are only shared with clients accepting the same encoding.
+    encoding = request.headers.get("Accept-Encoding")
+
+    # Blocking queries are cached under the same key as normal reads; the
+    # index of the cached response decides whether it can answer them.
+    index = request.query.get("index", "")
+    index = int(index) if index.isdigit() else None
+    query = tuple(sorted((name, value) for name, value in request.query.items() if name not in ("index", "wait")))
+    cache_key = (tail, query, credentials, encoding)
+
+    response = CACHE.get(cache_key, index) if CACHE is not None else None
+    if response is not None:
+        CACHE_REQUESTS.inc(result="hit")
+        request["ttfb"] = time.monotonic() - start
+        return from_cached_response(response, "HIT")
+    CACHE_REQUESTS.inc(result="miss")
+
+    flight_key = (tail, request.query_string, credentials, encoding)
+    flight = INFLIGHT.get(flight_key)
+    if flight is not None:
+        response = await asyncio.shield(flight)
+        if response is None:
+            return None
+
+        CACHE_REQUESTS.inc(result="coalesced")
+        request["ttfb"] = time.monotonic() - start
+        return from_cached_response(response, "COALESCED")
+
+    flight = asyncio.get_running_loop().create_future()
+    INFLIGHT[flight_key] = flight
+
+    def settle(response):
+        # Whatever happens to this request, never leave the ones that joined it waiting.
+        if not flight.done():
+            flight.set_result(response)
+        if INFLIGHT.get(flight_key) is flight:
+            del INFLIGHT[flight_key]
+
+    try:
+        async with SESSION.get(url, headers=headers) as proxy_response:
+            body, prefix = await read_limited(proxy_response)
+            if body is None:
+                settle(None)
+                return await relay_response(request, proxy_response, endpoint_class, start, prefix)
+
+        response = to_cached_response(proxy_response, body)
+        if CACHE is not None and response.status == 200:
+            CACHE.put(cache_key, response)
+        settle(response)
+    finally:
+        settle(None)
+
+    request["ttfb"] = time.monotonic() - start
+    return from_cached_response(response, "MISS")
+
+
+def normalize_endpoint(tail):
+    for pattern, replacement in ENDPOINT_PATTERNS:
+        match = pattern.match(tail)
+        if match:
+            return match.expand(replacement)
+    return "other"
+
+
+class MetricsAccessLogger(AccessLogger):
+    """
+    Log every request as a single JSON line, and record its metrics.
+    """
+
+    def log(self, request, response, time):
+        # Don't log the health-check and metrics; they are spammy.
+        if request.path in ("/healthz", "/metrics"):
+            return
+
+        endpoint = normalize_endpoint(request.path[1:])
+        ttfb = request.get("ttfb", time)
+        bytes_in = request.content.total_bytes
+        bytes_out = response.body_length
+
+        REQUEST_DURATION.observe(time, endpoint=endpoint, method=request.method)
+        TIME_TO_FIRST_BYTE.observe(ttfb, endpoint=endpoint, method=request.method)
+        REQUEST_BYTES.inc(bytes_in, endpoint=endpoint)
+        RESPONSE_BYTES.inc(bytes_out, endpoint=endpoint)
+
+        self.logger.info(
+            json.dumps(
+                {
+                    "remote": request.headers.get(REMOTE_IP_HEADER, request.remote),
+                    "method": request.method,
+                    "path": request.path,
+                    "endpoint": endpoint,
+                    "status": response.status,
+                    "cache": response.headers.get("X-Nomad-Proxy-Cache"),
+                    "ttfb": round(ttfb, 6),
+                    "duration": round(time, 6),
+                    "bytes_in": bytes_in,
+                    "bytes_out": bytes_out,
+                }
+            )
+        )
+
+
+@routes.get("/healthz")
+async def healthz_handler(request):
+    return web.HTTPOk()
+
+
+@routes.get("/metrics")
+async def metrics_handler(request):
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.expose())
+    return web.Response(text="\n".join(lines) + "\n", content_type="text/plain")
+
+
+WEBSOCKET_HEADERS = {
+    "upgrade",
+    "connection",
+    "sec-websocket-key",
+    "sec-websocket-version",
+    "sec-websocket-extensions",
+    "sec-websocket-protocol",
+}
+
+
+async def proxy_websocket(request, url, headers):
+    """
+    Relay a WebSocket (like "nomad alloc exec") frame by frame in both directions.
+    """
+
+    start = time.monotonic()
+    endpoint = normalize_endpoint(request.match_info["tail"])
+
+    # The handshake is done by aiohttp on both sides; only pass on the other headers.
+    headers = {name: value for name, value in headers.items() if name.lower() not in WEBSOCKET_HEADERS}
+    protocols = [
+        protocol.strip()
+        for protocol in request.headers.get("Sec-WebSocket-Protocol", "").split(",")
+        if protocol.strip()
+    ]
+
+    async with SESSION.ws_connect(url, headers=headers, protocols=protocols, max_msg_size=0) as upstream:
+        downstream = web.WebSocketResponse(protocols=[upstream.protocol] if upstream.protocol else (), max_msg_size=0)
+        await downstream.prepare(request)
+        request["ttfb"] = time.monotonic() - start
+
+        async def relay(source, target):
+            # Sending waits for the transport to drain, so a slow side slows down the other.
+            async for message in source:
+                if message.type == aiohttp.WSMsgType.TEXT:
+                    await target.send_str(message.data)
+                elif message.type == aiohttp.WSMsgType.BINARY:
+                    await target.send_bytes(message.data)
+                else:
+                    break
+
+                if target is downstream:
+                    STREAMED_BYTES.inc(len(message.data), endpoint=endpoint)
+
+        tasks = [
+            asyncio.ensure_future(relay(downstream, upstream)),
+            asyncio.ensure_future(relay(upstream, downstream)),
+        ]
+        OPEN_STREAMS.inc(endpoint=endpoint)
+        try:
+            await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            OPEN_STREAMS.dec(endpoint=endpoint)
+            for task in tasks:
+                task.cancel()
+
+        # Whichever side closed first, close the other with the same code.
+        code = downstream.close_code or upstream.close_code or aiohttp.WSCloseCode.OK
+        await upstream.close(code=code)
+        await downstream.close(code=code)
+        return downstream
+
+
+async def relay_response(request, proxy_response, endpoint_class, start, prefix=()):
+    """
+    Stream a response from Nomad to the client; "prefix" are chunks of it that were already read.
+    """
+
+    response = web.StreamResponse()
+    response.headers.update(proxy_response.headers)
+    response.set_status(proxy_response.status)
+
+    # Nomad returns application/json, even for streaming endpoints.
+    # Cloudflared uses content-type to detect streaming endpoints,
+    # and otherwise they buffer data. So we cheat here, and change
+    # the content-type to something cloudflared recognizes.
+    if endpoint_class.event_stream:
+        response.headers["Content-Type"] = "text/event-stream"
+    # If there is an index header, it's also a streaming endpoint.
+    if "X-Nomad-Index" in proxy_response.headers:
+        response.headers["Content-Type"] = "text/event-stream"
+
+    # Compressed bodies are passed on as they are. Streams are the
+    # exception: an event-stream is not expected to be compressed, and
+    # anything decoding it on the way would hold back data till a block
+    # is complete. So only those are decoded here; responses that are
+    # merely relabelled because of their index have a length, and stay
+    # compressed.
+    decoder = None
+    if endpoint_class.event_stream and "Content-Encoding" in response.headers:
+        if response.headers["Content-Encoding"] in ("gzip", "deflate"):
+            decoder = zlib.decompressobj(32 + zlib.MAX_WBITS)
+            del response.headers["Content-Encoding"]
+            response.headers.popall("Content-Length", None)
+
+    # With "plain", Nomad sends raw data instead of JSON frames; nothing can be added to that.
+    # Neither to errors, which are plain text.
+    framed = request.query.get("plain") != "true" and proxy_response.status == 200
+    heartbeat = endpoint_class.heartbeat if framed else None
+    # Wake up often enough for both the heartbeat and the idle timeout.
+    interval = heartbeat or endpoint_class.idle_timeout
+
+    endpoint = normalize_endpoint(request.match_info["tail"])
+    OPEN_STREAMS.inc(endpoint=endpoint)
+    try:
+        await response.prepare(request)
+        request["ttfb"] = time.monotonic() - start
+
+        if endpoint_class.flush and framed:
+            await response.write(HEARTBEAT)
+
+        last_read = time.monotonic()
+        last_byte = b"\n"
+
+        async def forward(chunk):
+            nonlocal last_byte
+
+            if decoder is not None:
+                chunk = decoder.decompress(chunk)
+            if chunk:
+                last_byte = chunk[-1:]
+            await response.write(chunk)
+            STREAMED_BYTES.inc(len(chunk), endpoint=endpoint)
+
+        async def relay():
+            nonlocal last_read
+
+            for chunk in prefix:
+                await forward(chunk)
+
+            # Relay whatever has arrived as one chunk; fewer, larger writes cost less
+            # CPU per MB than passing on every buffer as received. Writing waits for
+            # the client to drain, which in turn pauses reading from Nomad.
+            async for chunk in proxy_response.content.iter_any():
+                last_read = time.monotonic()
+                await forward(chunk)
+            if decoder is not None:
+                await response.write(decoder.flush())
+
+        if interval is None:
+            await relay()
+        else:
+            # Keep an eye on the relay from here, instead of putting a timeout on every read.
+            task = asyncio.ensure_future(relay())
+            try:
+                while not task.done():
+                    await asyncio.wait([task], timeout=interval)
+
+                    idle = time.monotonic() - last_read
+                    if endpoint_class.idle_timeout and idle >= endpoint_class.idle_timeout:
+                        break
+                    # Only between two frames; Nomad ends every frame with a newline.
+                    if heartbeat and idle >= heartbeat and last_byte == b"\n" and not task.done():
+                        await response.write(HEARTBEAT)
+                else:
+                    await task
+            finally:
+                task.cancel()
+    except ConnectionResetError:
+        pass
+    finally:
+        OPEN_STREAMS.dec(endpoint=endpoint)
+    return response
 
 
 @routes.route("*", "/{tail:.*}")
 async def proxy(request):
-    headers = dict(request.headers)
-    del headers["Host"]
-
-    data = await request.text()
-
-    async with aiohttp.ClientSession() as session:
-        command = getattr(session, request.method.lower())
-
-        async with command(
-            f"http://127.0.0.1:4646/{request.match_info['tail']}?{request.query_string}", data=data, headers=headers
-        ) as proxy_response:
-            response = web.StreamResponse()
-            response.headers.update(proxy_response.headers)
-            response.set_status(proxy_response.status)
-
-            # We decompressed the response, so we need to remove the Content-Encoding / Content-Length header.
-            if "Content-Encoding" in response.headers:
-                del response.headers["Content-Encoding"]
-            if "Content-Length" in response.headers:
-                del response.headers["Content-Length"]
-
-            # Nomad returns application/json, even for streaming endpoints.
-            # Cloudflared uses content-type to detect streaming endpoints,
-            # and otherwise they buffer data. So we cheat here, and change
-            # the content-type to something cloudflared recognizes.
-            for url in EVENT_STREAM_URLS:
-                if request.match_info["tail"].startswith(url):
-                    response.headers["Content-Type"] = "text/event-stream"
-            # If there is an index header, it's also a streaming endpoint.
-            if "X-Nomad-Index" in proxy_response.headers:
-                response.headers["Content-Type"] = "text/event-stream"
+    start = time.monotonic()
+    # The connection to Nomad is a different one; aiohttp frames the body for it.
+    headers = {
+        name: value
+        for name, value in request.headers.items()
+        if name.lower() != "host" and name.lower() not in HOP_BY_HOP_HEADERS
+    }
+    # Only ask Nomad for an encoding the client can handle, so compressed bodies can be passed on untouched.
+    if "Accept-Encoding" not in request.headers:
+        headers["Accept-Encoding"] = "identity"
 
-            try:
-                await response.prepare(request)
-
-                # Handle streaming data.
-                while not proxy_response.content.is_eof():
-                    while not proxy_response.content._buffer and not proxy_response.content._eof:
-                        await proxy_response.content._wait("read")
-                    await response.write(proxy_response.content.read_nowait(-1))
-
-                # Read the remaining of the existing buffer.
-                await response.write(proxy_response.content.read_nowait(-1))
-            except ConnectionResetError:
-                pass
+    if request.headers.get("Upgrade", "").lower() == "websocket":
+        return await proxy_websocket(
+            request, f"{UPSTREAM}/{request.match_info['tail']}?{request.query_string}", headers
+        )
+
+    endpoint_class = classify(request.match_info["tail"])
+    if request.method == "GET" and endpoint_class.cacheable:
+        response = await proxy_cached(
+            request, f"{UPSTREAM}/{request.match_info['tail']}?{request.query_string}", headers, endpoint_class, start
+        )
+        if response is not None:
             return response
+    # Anything else may change what Nomad returns.
+    if request.method != "GET" and CACHE is not None:
+        CACHE.clear()
+
+    # Stream the body to the upstream as it comes in, instead of buffering it.
+    data = request.content if request.body_exists else None
+
+    command = getattr(SESSION, request.method.lower())
+    async with command(
+        f"{UPSTREAM}/{request.match_info['tail']}?{request.query_string}", data=data, headers=headers
+    ) as proxy_response:
+        return await relay_response(request, proxy_response, endpoint_class, start)
+
+
+async def upstream_session_ctx(app):
+    """
+    Keep a single pool of keep-alive connections to Nomad for the lifetime of the proxy.
+    """
+
+    global SESSION
+
+    connector = aiohttp.TCPConnector(limit=POOL_LIMIT, keepalive_timeout=KEEPALIVE_TIMEOUT)
+    # Only bound connecting; streams and blocking queries legitimately stay open for a long time.
+    timeout = aiohttp.ClientTimeout(total=None, sock_connect=CONNECT_TIMEOUT)
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout, auto_decompress=False) as session:
+        SESSION = session
+        yield
+        SESSION = None
 
 
 def main():
+    global CACHE
+
+    logging.basicConfig(
+        format="%(asctime)s %(levelname)-8s [%(name)s] %(message)s", datefmt="%Y-%m-%d %H:%M:%S", level=logging.INFO
+    )
+
+    if CACHE_TTL > 0:
+        CACHE = ResponseCache(CACHE_TTL, CACHE_MAX_SIZE)
+
     app = web.Application()
+    app.cleanup_ctx.append(upstream_session_ctx)
     app.add_routes(routes)
-    web.run_app(app, port=8686)
+    web.run_app(app, port=PORT, access_log_class=MetricsAccessLogger)
 
 
 if __name__ == "__main__":
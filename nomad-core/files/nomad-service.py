@@ -7,23 +7,738 @@ Handles several endpoints related to deploying new software on the Nomad cluster
 import aiohttp
 import asyncio
 import base64
+import collections
+import contextlib
+import functools
+import hashlib
 import json
 import logging
+import os
+import re
 import shlex
 import signal
 import sys
+import time
 
 from aiohttp import web
 from aiohttp.web_log import AccessLogger
 
 REMOTE_IP_HEADER = "cf-connecting-ip"
-SERVICE_KEYS = {}
-SERVICES = {}
+NOMAD_ADDR = os.getenv("NOMAD_ADDR", "http://127.0.0.1:4646")
+NOMAD_TOKEN = os.getenv("NOMAD_TOKEN")
+RELOAD_CONCURRENCY = int(os.getenv("RELOAD_CONCURRENCY", "8"))
+RELOAD_TIMEOUT = float(os.getenv("RELOAD_TIMEOUT", "10"))
+DEPLOY_WAIT_TIMEOUT = int(os.getenv("DEPLOY_WAIT_TIMEOUT", "600"))
+DEPLOY_WAIT_TIMEOUT_MAX = 3600
+EVALUATION_POLL_INTERVAL = 0.5
+EVALUATION_TIMEOUT = 60
+NOMAD = None
+SESSION = None
+DEPLOY_QUEUE = None
+JOBSPEC_CACHE = {}
+PLACEHOLDER_RE = re.compile(r"\[\[ ([a-zA-Z0-9_.-]+) \]\]")
+DRAIN_WORKER = None
+DRAIN_CONCURRENCY = int(os.getenv("DRAIN_CONCURRENCY", "4"))
+DRAIN_BATCH_WINDOW = float(os.getenv("DRAIN_BATCH_WINDOW", "2"))
+DRAIN_FORGET_AFTER = 3600
+AUDIT_LOG = None
+AUDIT_LOG_FILE = "local/audit.log"
+AUDIT_LOG_MAX_SIZE = 10 * 1024 * 1024
+AUDIT_TAIL_LIMIT = 1000
+CONFIG_FILES = ("local/service-keys.json", "local/services.json")
+CONFIG_WATCH_INTERVAL = 5
+CONFIG = None
+CONFIG_LOCK = None
+METRICS_PORT = None
 
 routes = web.RouteTableDef()
 log = logging.getLogger(__name__)
 
 
+class Metric:
+    """
+    Minimal Prometheus metric; the node only has aiohttp installed, so no prometheus_client.
+    """
+
+    TYPE = None
+
+    def __init__(self, name, documentation, labelnames):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._values = {}
+
+        METRICS.append(self)
+
+    def _key(self, labels):
+        return tuple(labels[name] for name in self.labelnames)
+
+    def _format_labels(self, key, extra=None):
+        labels = [f'{name}="{value}"' for name, value in zip(self.labelnames, key)]
+        if extra:
+            labels.append(extra)
+        return "{" + ",".join(labels) + "}" if labels else ""
+
+    def expose(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.TYPE}"]
+        for key, value in sorted(self._values.items()):
+            lines.append(f"{self.name}{self._format_labels(key)} {value}")
+        return lines
+
+
+class Counter(Metric):
+    TYPE = "counter"
+
+    def inc(self, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + 1
+
+
+class Gauge(Metric):
+    TYPE = "gauge"
+
+    def inc(self, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + 1
+
+    def dec(self, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) - 1
+
+
+class Histogram(Metric):
+    TYPE = "histogram"
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        if key not in self._values:
+            self._values[key] = [[0] * len(self.BUCKETS), 0.0, 0]
+
+        buckets, _, _ = self._values[key]
+        for i, bucket in enumerate(self.BUCKETS):
+            if value <= bucket:
+                buckets[i] += 1
+        self._values[key][1] += value
+        self._values[key][2] += 1
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(time.monotonic() - start, **labels)
+
+    def expose(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.TYPE}"]
+        for key, (buckets, total, count) in sorted(self._values.items()):
+            for bucket, value in zip(self.BUCKETS, buckets):
+                le = f'le="{bucket}"'
+                lines.append(f"{self.name}_bucket{self._format_labels(key, le)} {value}")
+            le = 'le="+Inf"'
+            lines.append(f"{self.name}_bucket{self._format_labels(key, le)} {count}")
+            lines.append(f"{self.name}_sum{self._format_labels(key)} {total}")
+            lines.append(f"{self.name}_count{self._format_labels(key)} {count}")
+        return lines
+
+
+METRICS = []
+HANDLER_DURATION = Histogram(
+    "nomad_service_handler_duration_seconds", "Duration of handling a request.", ("handler", "service")
+)
+STEP_DURATION = Histogram(
+    "nomad_service_step_duration_seconds", "Duration of a single step within a handler.", ("handler", "step")
+)
+FAILURES = Counter(
+    "nomad_service_failures_total", "Number of failed API calls or subprocesses.", ("handler", "step", "kind")
+)
+IN_FLIGHT = Gauge("nomad_service_in_flight_requests", "Number of requests being handled.", ("handler", "service"))
+
+
+class Config:
+    """
+    Lookup structures built from service-keys.json and services.json.
+
+    A new instance is created on every reload and swapped in as a whole, so
+    a request never sees a mix of old and new files.
+    """
+
+    def __init__(self, service_keys, services, digest):
+        self.digest = digest
+        self.service_keys = {service: value["key"] for service, value in service_keys.items() if "key" in value}
+        self.reload_urls = {
+            service: tuple(
+                f"http://[{instance['address']}]:{instance['port']}/reload" for instance in instances if instance
+            )
+            for service, instances in services.items()
+        }
+
+    def is_valid_key(self, service, key):
+        return service in self.service_keys and self.service_keys[service] == key
+
+
+def load_config(digest=None):
+    """
+    Read and parse the configuration files; returns None if they didn't change since "digest".
+
+    This is blocking, so it is meant to be run in an executor.
+    """
+
+    contents = []
+    for filename in CONFIG_FILES:
+        with open(filename, "rb") as fp:
+            contents.append(fp.read())
+
+    new_digest = hashlib.sha256(b"\0".join(contents)).hexdigest()
+    if new_digest == digest:
+        return None
+
+    return Config(json.loads(contents[0]), json.loads(contents[1]), new_digest)
+
+
+async def reload_config():
+    global CONFIG
+
+    async with CONFIG_LOCK:
+        loop = asyncio.get_running_loop()
+        try:
+            config = await loop.run_in_executor(None, load_config, CONFIG.digest)
+        except Exception:
+            log.exception("Failed to reload files; keeping the current configuration.")
+            return
+
+        if config is None:
+            return
+
+        log.info("Reloaded files.")
+        CONFIG = config
+
+
+async def config_reload_ctx(app):
+    """
+    Reload the configuration on SIGHUP, and when the files change on disk.
+    """
+
+    global CONFIG_LOCK
+    CONFIG_LOCK = asyncio.Lock()
+
+    loop = asyncio.get_running_loop()
+    loop.add_signal_handler(signal.SIGHUP, lambda: loop.create_task(reload_config()))
+
+    async def watch():
+        last_stat = None
+
+        while True:
+            await asyncio.sleep(CONFIG_WATCH_INTERVAL)
+
+            try:
+                stat = tuple(os.stat(filename) for filename in CONFIG_FILES)
+                stat = tuple((entry.st_mtime_ns, entry.st_size) for entry in stat)
+            except OSError:
+                continue
+
+            if last_stat is not None and stat != last_stat:
+                await reload_config()
+            last_stat = stat
+
+    task = loop.create_task(watch())
+    yield
+    task.cancel()
+    loop.remove_signal_handler(signal.SIGHUP)
+
+
+def measured(handler):
+    """
+    Track duration and in-flight requests of a handler.
+
+    Unknown services are grouped together, to not have unbounded labels.
+    """
+
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(request):
+            service = request.match_info.get("service")
+            if service not in CONFIG.service_keys:
+                service = "unknown"
+
+            IN_FLIGHT.inc(handler=handler, service=service)
+            try:
+                with HANDLER_DURATION.time(handler=handler, service=service):
+                    return await func(request)
+            finally:
+                IN_FLIGHT.dec(handler=handler, service=service)
+
+        return wrapper
+
+    return decorator
+
+
+class NomadError(Exception):
+    pass
+
+
+class NomadClient:
+    """
+    Small client for the Nomad HTTP API of the local agent.
+
+    All calls share a single session, so the connection to the agent is
+    kept alive between deploys instead of spawning the Nomad CLI for every
+    step.
+    """
+
+    def __init__(self, session, address, token=None):
+        self._session = session
+        self._address = address.rstrip("/")
+        self._headers = {}
+        if token:
+            self._headers["X-Nomad-Token"] = token
+
+    async def _request(self, method, path, **kwargs):
+        async with self._session.request(
+            method, f"{self._address}/v1/{path}", headers=self._headers, **kwargs
+        ) as response:
+            if response.status >= 400:
+                body = (await response.text()).strip()
+                raise NomadError(f"{method} /v1/{path} returned {response.status}: {body}")
+            return await response.json()
+
+    async def var_get(self, path):
+        return await self._request("GET", f"var/{path}")
+
+    async def var_list(self, prefix):
+        return await self._request("GET", "vars", params={"prefix": prefix})
+
+    async def var_put(self, path, items):
+        return await self._request("PUT", f"var/{path}", json={"Path": path, "Items": items})
+
+    async def job_parse(self, jobspec):
+        return await self._request("POST", "jobs/parse", json={"JobHCL": jobspec, "Canonicalize": True})
+
+    async def job_register(self, job):
+        return await self._request("POST", "jobs", json={"Job": job})
+
+    async def evaluation(self, eval_id):
+        return await self._request("GET", f"evaluation/{eval_id}")
+
+    async def evaluation_allocations(self, eval_id):
+        return await self._request("GET", f"evaluation/{eval_id}/allocations")
+
+    async def deployment(self, deployment_id):
+        return await self._request("GET", f"deployment/{deployment_id}")
+
+    async def job_deployment(self, job_id):
+        return await self._request("GET", f"job/{job_id}/deployment")
+
+    async def event_stream(self, topics, index):
+        """
+        Yield the events of the given topics, starting at "index".
+        """
+
+        params = [("topic", topic) for topic in topics]
+        params.append(("index", str(index)))
+
+        async with self._session.get(
+            f"{self._address}/v1/event/stream",
+            params=params,
+            headers=self._headers,
+            # Nomad sends a heartbeat every 10 seconds; allocations in events can be big.
+            timeout=aiohttp.ClientTimeout(total=None, sock_connect=5, sock_read=60),
+            read_bufsize=4 * 1024 * 1024,
+        ) as response:
+            if response.status >= 400:
+                body = (await response.text()).strip()
+                raise NomadError(f"GET /v1/event/stream returned {response.status}: {body}")
+
+            async for line in response.content:
+                line = line.strip()
+                if not line:
+                    continue
+
+                for event in json.loads(line).get("Events", []):
+                    yield event
+
+
+class JobspecTemplate:
+    """
+    A jobspec with its "[[ key ]]" placeholders split out once.
+
+    The settings are filled in when the template is created; what remains
+    (like the version) is filled in by render() in a single pass.
+    """
+
+    def __init__(self, jobspec, settings):
+        self._parts = []
+
+        for i, part in enumerate(PLACEHOLDER_RE.split(jobspec)):
+            # The split alternates between literal text and placeholder keys.
+            if i % 2 == 1 and part not in settings:
+                self._parts.append((True, part))
+                continue
+            if i % 2 == 1:
+                part = settings[part]
+
+            if self._parts and not self._parts[-1][0]:
+                self._parts[-1] = (False, self._parts[-1][1] + part)
+            else:
+                self._parts.append((False, part))
+
+    def render(self, variables):
+        return "".join(
+            variables.get(text, f"[[ {text} ]]") if is_placeholder else text for is_placeholder, text in self._parts
+        )
+
+
+async def nomad_client_ctx(app):
+    global NOMAD
+
+    connector = aiohttp.TCPConnector(limit=10, keepalive_timeout=60)
+    timeout = aiohttp.ClientTimeout(total=60, sock_connect=5)
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+        NOMAD = NomadClient(session, NOMAD_ADDR, NOMAD_TOKEN)
+        yield
+        NOMAD = None
+
+
+async def http_session_ctx(app):
+    global SESSION
+
+    connector = aiohttp.TCPConnector(limit=RELOAD_CONCURRENCY * 2, keepalive_timeout=60)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        SESSION = session
+        yield
+        SESSION = None
+
+
+class DeployQueue:
+    """
+    Serializes deploys per service, while different services deploy in parallel.
+
+    While a deploy is running, newer requests for the same service wait their
+    turn. When that comes, only the most recent version of those waiting is
+    rolled out, once, on behalf of all of them: every waiting request is sent
+    the progress and the outcome of that deploy. A deploy is carried out even
+    if the client that asked for it disconnects halfway.
+    """
+
+    def __init__(self):
+        self._locks = collections.defaultdict(asyncio.Lock)
+        self._waiting = collections.defaultdict(list)
+
+    async def submit(self, service, version, reply, deploy):
+        """
+        Queue a deploy of "version"; "deploy" is called as deploy(version, reply) to do the actual work.
+
+        Returns the version that was deployed instead (or None), and what deploy() returned (None if it failed).
+        """
+
+        loop = asyncio.get_running_loop()
+
+        if self._locks[service].locked():
+            await reply(f"Waiting for running deploy of {service} to finish ...\n")
+
+        future = loop.create_future()
+        self._waiting[service].append((version, reply, deploy, future))
+        # The first request to queue up starts the deploy; the others join it till it takes the lock.
+        if len(self._waiting[service]) == 1:
+            loop.create_task(self._run(service))
+
+        # Leave the deploy running if this request is cancelled; other requests might depend on it.
+        return await asyncio.shield(future)
+
+    async def _run(self, service):
+        async with self._locks[service]:
+            batch = self._waiting.pop(service)
+            version, _, deploy, _ = batch[-1]
+
+            async def send(client_reply, message):
+                try:
+                    await client_reply(message)
+                except ConnectionResetError:
+                    # The client is gone; keep deploying for the others.
+                    pass
+
+            async def reply(message):
+                for _, client_reply, _, _ in batch:
+                    await send(client_reply, message)
+
+            for waiting_version, client_reply, _, _ in batch[:-1]:
+                await send(
+                    client_reply,
+                    f"Deploy of {waiting_version} to {service} is superseded by {version}; deploying that.\n",
+                )
+
+            try:
+                result = await deploy(version, reply)
+            except web.HTTPException:
+                # deploy() already told why.
+                result = None
+            except Exception:
+                log.exception(f"Deploy of {version} to {service} failed")
+                await reply(f"ERROR: Deploy of {version} to {service} failed.\n")
+                result = None
+
+            for waiting_version, _, _, future in batch:
+                future.set_result((None if waiting_version == version else version, result))
+
+
+async def deploy_queue_startup(app):
+    global DEPLOY_QUEUE
+    DEPLOY_QUEUE = DeployQueue()
+
+
+class AuditLog:
+    """
+    Append-only log of every deploy, reload and autoscaling action, one JSON record per line.
+
+    When the file grows beyond AUDIT_LOG_MAX_SIZE, it is rotated to ".1".
+    """
+
+    def __init__(self, filename):
+        self._filename = filename
+        self._fp = open(filename, "a")
+
+    def write(self, data):
+        self._fp.write(json.dumps(data, separators=(",", ":")) + "\n")
+        self._fp.flush()
+
+        if self._fp.tell() > AUDIT_LOG_MAX_SIZE:
+            self._fp.close()
+            os.replace(self._filename, f"{self._filename}.1")
+            self._fp = open(self._filename, "a")
+
+    def close(self):
+        self._fp.close()
+
+    def tail(self, limit, **filters):
+        """
+        Return the last "limit" records matching all filters.
+
+        Only "limit" records are kept in memory while reading; this is
+        blocking, so it is meant to be run in an executor.
+        """
+
+        records = collections.deque(maxlen=limit)
+
+        for filename in (f"{self._filename}.1", self._filename):
+            try:
+                fp = open(filename)
+            except FileNotFoundError:
+                continue
+
+            with fp:
+                for line in fp:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue
+
+                    if all(record.get(name) == value for name, value in filters.items()):
+                        records.append(line)
+
+        return list(records)
+
+
+class AuditRecord:
+    """
+    A single entry for the audit log, with per-step timings.
+
+    Use as context manager; on exit the record is written. If no outcome was
+    set by then, the action is recorded as failed.
+    """
+
+    def __init__(self, action, service, remote, **fields):
+        self._start = time.monotonic()
+        self.outcome = None
+        self.data = {
+            "time": int(time.time()),
+            "action": action,
+            "service": service,
+            "remote": remote,
+            **fields,
+            "steps": {},
+        }
+
+    @contextlib.contextmanager
+    def step(self, name):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            duration = time.monotonic() - start
+            STEP_DURATION.observe(duration, handler=self.data["action"], step=name)
+            self.data["steps"][name] = round(self.data["steps"].get(name, 0) + duration, 4)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.data["outcome"] = self.outcome or "failed"
+        self.data["duration"] = round(time.monotonic() - self._start, 4)
+        AUDIT_LOG.write(self.data)
+
+
+async def audit_log_ctx(app):
+    global AUDIT_LOG
+
+    AUDIT_LOG = AuditLog(AUDIT_LOG_FILE)
+    yield
+    AUDIT_LOG.close()
+
+
+class CommandError(Exception):
+    pass
+
+
+async def run_command(record, command):
+    """
+    Run a command, and return its stdout.
+    """
+
+    command_args = shlex.split(command)
+    step = " ".join(command_args[:3])
+
+    with record.step(step):
+        proc = await asyncio.create_subprocess_exec(
+            command_args[0],
+            *command_args[1:],
+            stdout=asyncio.subprocess.PIPE,
+        )
+        stdout, _ = await proc.communicate()
+
+    if proc.returncode != 0:
+        FAILURES.inc(handler=record.data["action"], step=step, kind="subprocess")
+        raise CommandError(f"Executing {command} failed.")
+
+    return stdout.decode().strip()
+
+
+class DrainWorker:
+    """
+    Removes terminating instances from the cluster in the background.
+
+    Notifications arriving close together are handled as one batch: a single
+    describe-instances call for all of them, after which the nodes are drained
+    in parallel (bounded by DRAIN_CONCURRENCY). The state of every instance is
+    tracked, so duplicate SNS deliveries don't drain the same node twice.
+    """
+
+    def __init__(self):
+        self._queue = asyncio.Queue()
+        self._state = {}
+        self._semaphore = asyncio.Semaphore(DRAIN_CONCURRENCY)
+
+    def submit(self, service, remote, instance, lifecycle_hook_name, auto_scaling_group_name):
+        state = self._state.get(instance)
+        if state is not None and state != "failed":
+            log.info(f"Ignoring duplicate termination notification for {instance} ({state})")
+            return
+
+        self._state[instance] = "queued"
+        self._queue.put_nowait((service, remote, instance, lifecycle_hook_name, auto_scaling_group_name))
+
+    async def run(self):
+        while True:
+            batch = [await self._queue.get()]
+
+            # Give other notifications of the same scale-in a moment to arrive.
+            await asyncio.sleep(DRAIN_BATCH_WINDOW)
+            while not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+
+            try:
+                await self._process(batch)
+            except Exception:
+                log.exception("Failed to process terminating instances")
+                for _, _, instance, _, _ in batch:
+                    self._set_state(instance, "failed")
+
+    async def _process(self, batch):
+        instances = " ".join(instance for _, _, instance, _, _ in batch)
+
+        # Get the Private IP DNS name of all the instances in one go.
+        with AuditRecord("autoscaling", batch[0][0], batch[0][1], instances=instances.split(" ")) as record:
+            output = await run_command(
+                record,
+                f"aws ec2 describe-instances --instance-ids {instances} --query 'Reservations[].Instances[].[InstanceId,PrivateDnsName]' --output json",
+            )
+            record.outcome = "success"
+        instance_names = dict(json.loads(output))
+
+        await asyncio.gather(
+            *[
+                self._drain(
+                    service,
+                    remote,
+                    instance,
+                    instance_names.get(instance),
+                    lifecycle_hook_name,
+                    auto_scaling_group_name,
+                )
+                for service, remote, instance, lifecycle_hook_name, auto_scaling_group_name in batch
+            ]
+        )
+
+    async def _drain(self, service, remote, instance, instance_name, lifecycle_hook_name, auto_scaling_group_name):
+        if not instance_name:
+            log.error(f"No instance name found for {instance}")
+            self._set_state(instance, "failed")
+            return
+
+        async with self._semaphore:
+            self._set_state(instance, "draining")
+
+            with AuditRecord("autoscaling", service, remote, instance=instance, state="Terminating") as record:
+                try:
+                    # Find the node ID of the instance.
+                    node_id = await run_command(
+                        record, f"nomad node status -filter '\"{instance_name}\" in Name' -quiet"
+                    )
+                    if not node_id:
+                        log.error(f"No node ID found for {instance_name}")
+                        self._set_state(instance, "failed")
+                        return
+
+                    log.info(f"Removing {instance} ({instance_name}) with node ID {node_id} from the cluster")
+
+                    # Make sure no new jobs are scheduled on the instance.
+                    await run_command(record, f"nomad node eligibility -disable {node_id}")
+
+                    # Drain the instance (including system jobs).
+                    await run_command(record, f"nomad node drain -yes -enable {node_id}")
+
+                    # Mark the node as ready for termination.
+                    await run_command(
+                        record,
+                        f"aws autoscaling complete-lifecycle-action --lifecycle-action-result CONTINUE --instance-id {instance} --lifecycle-hook-name {lifecycle_hook_name} --auto-scaling-group-name {auto_scaling_group_name}",
+                    )
+                except CommandError as e:
+                    log.error(str(e))
+                    self._set_state(instance, "failed")
+                    return
+
+                record.outcome = "success"
+
+        log.info(f"Removed {instance} ({instance_name}) from the cluster")
+        self._set_state(instance, "done")
+
+    def _set_state(self, instance, state):
+        self._state[instance] = state
+
+        # Instance IDs are never reused; remember finished ones long enough to catch SNS redeliveries.
+        if state == "done":
+            asyncio.get_running_loop().call_later(DRAIN_FORGET_AFTER, self._state.pop, instance, None)
+
+
+async def drain_worker_ctx(app):
+    global DRAIN_WORKER
+
+    DRAIN_WORKER = DrainWorker()
+    task = asyncio.get_running_loop().create_task(DRAIN_WORKER.run())
+    yield
+    task.cancel()
+
+
 class MyAccessLogger(AccessLogger):
     def log(self, request, response, time):
         # Don't log the health-check; it is spammy.
@@ -47,7 +762,30 @@ async def healthz_handler(request):
     return web.HTTPOk()
 
 
+async def metrics_handler(request):
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.expose())
+    return web.Response(text="\n".join(lines) + "\n", content_type="text/plain")
+
+
+async def metrics_site_ctx(app):
+    """
+    Serve /metrics on a port of its own; unlike the main port, it is not published to the internet.
+    """
+
+    metrics_app = web.Application()
+    metrics_app.router.add_get("/metrics", metrics_handler)
+
+    runner = web.AppRunner(metrics_app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, port=METRICS_PORT).start()
+    yield
+    await runner.cleanup()
+
+
 @routes.post("/autoscaling/{service}/{key}")
+@measured("autoscaling")
 async def autoscaling_handler(request):
     if "[[ target ]]" != "aws":
         return web.HTTPNotFound()
@@ -60,14 +798,14 @@ async def autoscaling_handler(request):
         type = payload["Type"]
         log.info(f"Receiving SNS notification: {type}")
 
-        if service not in SERVICE_KEYS or SERVICE_KEYS[service]["key"] != key:
+        if not CONFIG.is_valid_key(service, key):
             log.error("Invalid service or service key")
             return web.HTTPOk()
 
         if type == "SubscriptionConfirmation":
             url = payload["SubscribeURL"]
-            async with aiohttp.ClientSession() as session:
-                await session.get(url)
+            async with SESSION.get(url):
+                pass
             return web.HTTPOk()
 
         if type == "Notification":
@@ -80,53 +818,18 @@ async def autoscaling_handler(request):
             log.info(f"SNS notification is an autoscaling notification: {message['LifecycleTransition']}")
 
             if message["LifecycleTransition"] == "autoscaling:EC2_INSTANCE_TERMINATING":
-                instance = message["EC2InstanceId"]
-
-                async def execute(command):
-                    command_args = shlex.split(command)
-
-                    proc = await asyncio.create_subprocess_exec(
-                        command_args[0],
-                        *command_args[1:],
-                        stdout=asyncio.subprocess.PIPE,
-                    )
-
-                    if await proc.wait() != 0:
-                        log.error(f"Executing {command} failed.\n")
-                        raise web.HTTPOk()
-
-                    return (await proc.stdout.read()).decode().strip()
-
-                # Get the Private IP DNS name of the instance.
-                instance_name = await execute(
-                    f"aws ec2 describe-instances --instance-ids {instance} --query 'Reservations[0].Instances[0].PrivateDnsName' --output text"
-                )
-                if not instance_name:
-                    log.error(f"No instance name found for {instance}")
-                    return web.HTTPOk()
-
-                # Find the node ID of the instance.
-                node_id = await execute(f"nomad node status -filter '\"{instance_name}\" in Name' -quiet")
-                if not node_id:
-                    log.error(f"No node ID found for {instance_name}")
-                    return web.HTTPOk()
-
-                log.info(f"Removing {instance} ({instance_name}) with node ID {node_id} from the cluster")
-
-                # Make sure no new jobs are scheduled on the instance.
-                await execute(f"nomad node eligibility -disable {node_id}")
-
-                # Drain the instance (including system jobs).
-                await execute(f"nomad node drain -yes -enable {node_id}")
-
-                # Mark the node as ready for termination.
-                await execute(
-                    f"aws autoscaling complete-lifecycle-action --lifecycle-action-result CONTINUE --instance-id {instance} --lifecycle-hook-name {message['LifecycleHookName']} --auto-scaling-group-name {message['AutoScalingGroupName']}"
+                # Draining takes a while; SNS only needs to know we received it.
+                DRAIN_WORKER.submit(
+                    service,
+                    request.remote,
+                    message["EC2InstanceId"],
+                    message["LifecycleHookName"],
+                    message["AutoScalingGroupName"],
                 )
 
         return web.HTTPOk()
 
-    if service not in SERVICE_KEYS or SERVICE_KEYS[service]["key"] != key:
+    if not CONFIG.is_valid_key(service, key):
         return web.HTTPNotFound()
     if "instance" not in payload or "state" not in payload:
         return web.HTTPNotFound()
@@ -146,50 +849,60 @@ async def autoscaling_handler(request):
 
     async def execute(command):
         command_args = shlex.split(command)
+        step = " ".join(command_args[:3])
 
-        proc = await asyncio.create_subprocess_exec(
-            command_args[0],
-            *command_args[1:],
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.STDOUT,
-        )
+        with record.step(step):
+            proc = await asyncio.create_subprocess_exec(
+                command_args[0],
+                *command_args[1:],
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.STDOUT,
+            )
 
-        while True:
-            line = await proc.stdout.readline()
-            if not line:
-                break
-            await reply(line.decode())
+            while True:
+                line = await proc.stdout.readline()
+                if not line:
+                    break
+                await reply(line.decode())
+
+            returncode = await proc.wait()
 
-        if await proc.wait() != 0:
+        if returncode != 0:
+            FAILURES.inc(handler="autoscaling", step=step, kind="subprocess")
             await reply(f"ERROR: Executing {command} failed.\n")
             raise web.HTTPInternalServerError()
 
     log.info(f"Received {state} state for {instance} in {service}")
 
-    if state == "Healthy":
-        await execute(f"aws autoscaling set-instance-health --instance-id {instance} --health-status Healthy")
+    with AuditRecord("autoscaling", service, request.remote, instance=instance, state=state) as record:
+        if state == "Healthy":
+            await execute(f"aws autoscaling set-instance-health --instance-id {instance} --health-status Healthy")
 
-    if state == "Unhealthy":
-        await execute(f"aws autoscaling set-instance-health --instance-id {instance} --health-status Unhealthy")
+        if state == "Unhealthy":
+            await execute(f"aws autoscaling set-instance-health --instance-id {instance} --health-status Unhealthy")
 
-    if state == "Continue":
-        lifecycle_hook_name = payload["lifecycle-hook-name"]
-        await execute(
-            f"aws autoscaling complete-lifecycle-action --lifecycle-action-result CONTINUE --instance-id {instance} --lifecycle-hook-name {lifecycle_hook_name} --auto-scaling-group-name {service}"
-        )
+        if state == "Continue":
+            lifecycle_hook_name = payload["lifecycle-hook-name"]
+            await execute(
+                f"aws autoscaling complete-lifecycle-action --lifecycle-action-result CONTINUE --instance-id {instance} --lifecycle-hook-name {lifecycle_hook_name} --auto-scaling-group-name {service}"
+            )
+
+        record.outcome = "success"
 
     return response
 
 
 @routes.post("/reload/{service}/{key}")
+@measured("reload")
 async def reload_handler(request):
     service = request.match_info["service"]
     key = request.match_info["key"]
     payload = await request.json()
 
-    if service not in SERVICE_KEYS or SERVICE_KEYS[service]["key"] != key:
+    config = CONFIG
+    if not config.is_valid_key(service, key):
         return web.HTTPNotFound()
-    if service not in SERVICES:
+    if service not in config.reload_urls:
         return web.HTTPNotFound()
     if "secret" not in payload:
         return web.HTTPNotFound()
@@ -201,35 +914,269 @@ async def reload_handler(request):
     response.set_status(200)
     await response.prepare(request)
 
-    async with aiohttp.ClientSession() as session:
-        for service in SERVICES[service]:
-            if not service:
-                continue
-
-            url = f"http://[{service['address']}]:{service['port']}/reload"
-            await response.write(f"Calling {url} ...\n".encode())
-            reload_response = await session.post(url, json={"secret": secret})
-            if reload_response.status >= 400:
-                await response.write(f"  FAIL\n\n".encode())
-            else:
-                await response.write(f"  OK\n\n".encode())
+    semaphore = asyncio.Semaphore(RELOAD_CONCURRENCY)
+    timeout = aiohttp.ClientTimeout(total=RELOAD_TIMEOUT)
+
+    async def reload_instance(url):
+        async with semaphore:
+            with record.step("reload_instance"):
+                try:
+                    async with SESSION.post(url, json={"secret": secret}, timeout=timeout) as reload_response:
+                        if reload_response.status >= 400:
+                            result = f"FAIL (status {reload_response.status})"
+                        else:
+                            result = "OK"
+                except asyncio.TimeoutError:
+                    result = "FAIL (timeout)"
+                except aiohttp.ClientError as e:
+                    result = f"FAIL ({e})"
+
+            if result != "OK":
+                FAILURES.inc(handler="reload", step="reload_instance", kind="api")
+            return url, result
+
+    with AuditRecord("reload", service, request.remote, failures=0) as record:
+        # Reload all instances in parallel, and report back as soon as each one finishes.
+        tasks = [reload_instance(url) for url in config.reload_urls[service]]
+        for task in asyncio.as_completed(tasks):
+            url, result = await task
+            if result != "OK":
+                record.data["failures"] += 1
+            await response.write(f"Calling {url} ...\n  {result}\n\n".encode())
+
+        record.outcome = "success" if record.data["failures"] == 0 else "failed"
 
     await response.write("All instances reloaded.\n".encode())
     return response
 
 
+def timestamp():
+    return time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
+
+
+async def monitor_evaluation(eval_id, reply):
+    """
+    Report on an evaluation the way "nomad job run" does, till it is no longer pending.
+
+    Returns the evaluation, and why it failed (None if it succeeded).
+    """
+
+    await reply(f'==> {timestamp()}: Monitoring evaluation "{eval_id[:8]}"\n')
+
+    status = "pending"
+    triggered = False
+    while True:
+        evaluation = await NOMAD.evaluation(eval_id)
+
+        if not triggered:
+            await reply(f'    {timestamp()}: Evaluation triggered by job "{evaluation["JobID"]}"\n')
+            triggered = True
+        if evaluation["Status"] != status:
+            await reply(f'    {timestamp()}: Evaluation status changed: "{status}" -> "{evaluation["Status"]}"\n')
+            status = evaluation["Status"]
+
+        if status != "pending":
+            break
+        await asyncio.sleep(EVALUATION_POLL_INTERVAL)
+
+    if evaluation.get("DeploymentID"):
+        await reply(f'    {timestamp()}: Evaluation within deployment: "{evaluation["DeploymentID"][:8]}"\n')
+
+    for allocation in await NOMAD.evaluation_allocations(eval_id):
+        await reply(
+            f'    {timestamp()}: Allocation "{allocation["ID"][:8]}" created: '
+            f'node "{allocation["NodeID"][:8]}", group "{allocation["TaskGroup"]}"\n'
+        )
+
+    failed = evaluation.get("FailedTGAllocs") or {}
+    if failed:
+        await reply(
+            f'==> {timestamp()}: Evaluation "{eval_id[:8]}" finished with status "{status}" '
+            "but failed to place all allocations:\n"
+        )
+        for group, metrics in failed.items():
+            count = metrics.get("CoalescedFailures", 0) + 1
+            await reply(f'    Task Group "{group}" (failed to place {count} allocation{"s" if count > 1 else ""})\n')
+    else:
+        await reply(f'==> {timestamp()}: Evaluation "{eval_id[:8]}" finished with status "{status}"\n')
+
+    if failed:
+        return evaluation, f"Not all allocations of job {evaluation['JobID']} could be placed."
+    if status != "complete":
+        return evaluation, f'Evaluation of job {evaluation["JobID"]} finished with status "{status}".'
+    return evaluation, None
+
+
+async def deploy(service, version, reply, record):
+    async def execute(step, description, coro):
+        try:
+            with record.step(step):
+                return await coro
+        except (aiohttp.ClientError, asyncio.TimeoutError, NomadError) as e:
+            FAILURES.inc(handler="deploy", step=step, kind="api")
+            await reply(f"ERROR: {description} failed: {e}\n")
+            raise web.HTTPInternalServerError()
+
+    # Set the new version.
+    await reply(f"Setting new version to {version} ...\n")
+    variable = await execute(
+        "var_put", f"Setting app/{service}/version", NOMAD.var_put(f"app/{service}/version", {"version": version})
+    )
+    await reply(f'Created variable "app/{service}/version" with modify index {variable["ModifyIndex"]}\n')
+
+    # Check whether the settings / jobspec changed since the last deploy.
+    variables = await execute("var_list", f"Listing app/{service}/", NOMAD.var_list(f"app/{service}/"))
+    indexes = {variable["Path"]: variable["ModifyIndex"] for variable in variables}
+    settings_index = indexes.get(f"app/{service}/settings")
+    jobspec_index = indexes.get(f"app/{service}/jobspec")
+
+    cached = JOBSPEC_CACHE.get(service)
+    if cached and cached[0] == settings_index and cached[1] == jobspec_index:
+        await reply(f"\nUsing cached settings and jobspec for {service} ...\n")
+        template = cached[2]
+    else:
+        # Retrieve the settings.
+        await reply(f"\nRetrieving settings for {service} ...\n")
+        settings = await execute(
+            "settings_fetch", f"Retrieving app/{service}/settings", NOMAD.var_get(f"app/{service}/settings")
+        )
+
+        # Read the jobspec.
+        await reply(f"\nRetrieving jobspec for {service} ...\n")
+        jobspec = await execute(
+            "jobspec_fetch", f"Retrieving app/{service}/jobspec", NOMAD.var_get(f"app/{service}/jobspec")
+        )
+
+        template = JobspecTemplate(base64.b64decode(jobspec["Items"]["jobspec"]).decode(), settings["Items"])
+        JOBSPEC_CACHE[service] = (settings["ModifyIndex"], jobspec["ModifyIndex"], template)
+
+    # Replace all the variables.
+    await reply(f"\nCreating updated jobspec ...\n")
+    with record.step("render"):
+        jobspec = template.render({"version": version})
+
+    # Parse and register it.
+    await reply(f"\nUpdating job {service} with new jobspec ...\n")
+    job = await execute("job_run", f"Parsing jobspec for {service}", NOMAD.job_parse(jobspec))
+    result = await execute("job_run", f"Registering job {service}", NOMAD.job_register(job))
+    if result.get("Warnings"):
+        await reply(f"Job Warnings:\n{result['Warnings']}\n")
+
+    # Periodic and parameterized jobs are not evaluated on registration.
+    if not result.get("EvalID"):
+        await reply("Job registration successful\n")
+        return job["ID"], result["JobModifyIndex"], None
+
+    evaluation, error = await execute(
+        "job_run",
+        f"Monitoring evaluation for {service}",
+        asyncio.wait_for(monitor_evaluation(result["EvalID"], reply), EVALUATION_TIMEOUT),
+    )
+    if error:
+        FAILURES.inc(handler="deploy", step="job_run", kind="api")
+        await reply(f"ERROR: {error}\n")
+        raise web.HTTPInternalServerError()
+
+    return job["ID"], result["JobModifyIndex"], evaluation.get("DeploymentID") or None
+
+
+async def follow_deployment(job_id, job_modify_index, deployment_id, reply, record, timeout):
+    """
+    Follow the deployment created by a job registration, till it settles.
+
+    "deployment_id" comes from the evaluation of the registration; if it has
+    none, the latest deployment of the job is used if it belongs to this
+    version of the job. Without a deployment (the job didn't change, or it
+    doesn't do deployments) there is nothing to wait for.
+
+    Allocation health transitions are streamed back while waiting.
+    """
+
+    allocations = {}
+
+    async def follow():
+        nonlocal deployment_id
+
+        if deployment_id is None:
+            deployment = await NOMAD.job_deployment(job_id)
+            if deployment is None or deployment["JobModifyIndex"] != job_modify_index:
+                return None, None
+            deployment_id = deployment["ID"]
+        else:
+            deployment = await NOMAD.deployment(deployment_id)
+
+        await reply(f"\nFollowing deployment {deployment_id[:8]} ...\n")
+        if deployment["Status"] in ("successful", "failed", "cancelled"):
+            return deployment["Status"], deployment["StatusDescription"]
+
+        async for event in NOMAD.event_stream([f"Deployment:{job_id}", f"Allocation:{job_id}"], job_modify_index):
+            if event["Topic"] == "Deployment":
+                deployment = event["Payload"]["Deployment"]
+                if deployment["ID"] != deployment_id:
+                    continue
+
+                if deployment["Status"] in ("successful", "failed", "cancelled"):
+                    return deployment["Status"], deployment["StatusDescription"]
+
+            if event["Topic"] == "Allocation":
+                allocation = event["Payload"]["Allocation"]
+                if allocation.get("DeploymentID") != deployment_id:
+                    continue
+
+                healthy = (allocation.get("DeploymentStatus") or {}).get("Healthy")
+                health = "pending" if healthy is None else ("healthy" if healthy else "unhealthy")
+                status = (allocation["ClientStatus"], health)
+
+                if allocations.get(allocation["ID"]) != status:
+                    allocations[allocation["ID"]] = status
+                    await reply(f"  Allocation {allocation['ID'][:8]}: {status[0]}, {status[1]}\n")
+
+        raise NomadError("event stream closed")
+
+    try:
+        with record.step("rollout"):
+            status, description = await asyncio.wait_for(follow(), timeout)
+    except asyncio.TimeoutError:
+        await reply(f"ERROR: Deployment did not finish within {timeout} seconds.\n")
+        raise web.HTTPInternalServerError()
+    except (aiohttp.ClientError, NomadError) as e:
+        FAILURES.inc(handler="deploy", step="rollout", kind="api")
+        await reply(f"ERROR: Following deployment failed: {e}\n")
+        raise web.HTTPInternalServerError()
+
+    if status is None:
+        await reply("\nNo deployment was created for this version of the job; nothing to wait for.\n")
+        return
+
+    if status != "successful":
+        await reply(f"ERROR: Deployment {status}: {description}\n")
+        raise web.HTTPInternalServerError()
+
+    await reply(f"Deployment {status}: {description}\n")
+
+
 @routes.post("/deploy/{service}/{key}")
+@measured("deploy")
 async def deploy_handler(request):
     service = request.match_info["service"]
     key = request.match_info["key"]
     payload = await request.json()
 
-    if service not in SERVICE_KEYS or SERVICE_KEYS[service]["key"] != key:
+    if not CONFIG.is_valid_key(service, key):
         return web.HTTPNotFound()
     if "version" not in payload:
         return web.HTTPNotFound()
 
     version = payload["version"]
+    wait = payload.get("wait", False)
+    if not isinstance(wait, bool):
+        return web.HTTPBadRequest()
+    try:
+        wait_timeout = min(int(payload.get("wait-timeout", DEPLOY_WAIT_TIMEOUT)), DEPLOY_WAIT_TIMEOUT_MAX)
+    except (TypeError, ValueError):
+        return web.HTTPBadRequest()
+    if wait_timeout <= 0:
+        return web.HTTPBadRequest()
 
     response = web.StreamResponse()
     response.headers["Content-Type"] = "text/event-stream"
@@ -239,69 +1186,54 @@ async def deploy_handler(request):
     async def reply(message):
         await response.write(message.encode())
 
-    async def execute(command, capture):
-        command_args = shlex.split(command)
+    with AuditRecord("deploy", service, request.remote, version=version) as record:
+        superseded_by, result = await DEPLOY_QUEUE.submit(
+            service, version, reply, functools.partial(deploy, service, record=record)
+        )
+        if superseded_by is not None:
+            record.data["superseded_by"] = superseded_by
+            version = superseded_by
+        if result is None:
+            raise web.HTTPInternalServerError()
 
-        if capture:
-            proc = await asyncio.create_subprocess_exec(
-                command_args[0],
-                *command_args[1:],
-                stdout=asyncio.subprocess.PIPE,
-            )
-        else:
-            proc = await asyncio.create_subprocess_exec(
-                command_args[0],
-                *command_args[1:],
-                stdout=asyncio.subprocess.PIPE,
-                stderr=asyncio.subprocess.STDOUT,
-            )
+        job_id, job_modify_index, deployment_id = result
 
-            while True:
-                line = await proc.stdout.readline()
-                if not line:
-                    break
-                await reply(line.decode())
+        # Follow the rollout outside of the queue; a newer deploy cancels this one anyway.
+        if wait:
+            await follow_deployment(job_id, job_modify_index, deployment_id, reply, record, wait_timeout)
 
-        if await proc.wait() != 0:
-            await reply(f"ERROR: Executing {command} failed.\n")
-            raise web.HTTPInternalServerError()
+        record.outcome = "success"
 
-        if capture:
-            return await proc.stdout.read()
+    await reply(f"\nDeployed {version} to {service}\n")
+    return response
 
-    # Set the new version; double-escape the first @, as a @ has special meaning for "nomad var put".
-    await reply(f"Setting new version to {version} ...\n")
-    if version.startswith("@"):
-        safe_version = f"\\\\@{version[1:]}"
-    else:
-        safe_version = version
-    await execute(f"nomad var put -force app/{service}/version version={safe_version}", False)
-
-    # Retrieve the settings.
-    await reply(f"\nRetrieving settings for {service} ...\n")
-    settings_raw = await execute(f"nomad var get -out json app/{service}/settings", True)
-    settings = json.loads(settings_raw)["Items"]
-
-    # Read the jobspec.
-    await reply(f"\nRetrieving jobspec for {service} ...\n")
-    jobspec = await execute(
-        f"nomad var get -out go-template -template '{{{{ .Items.jobspec }}}}' app/{service}/jobspec", True
-    )
-    jobspec = base64.b64decode(jobspec).decode()
 
-    # Replace all the variables.
-    await reply(f"\nCreating updated jobspec ...\n")
-    for key, value in settings.items():
-        jobspec = jobspec.replace(f"[[ {key} ]]", value)
-    jobspec = jobspec.replace("[[ version ]]", version)
+@routes.get("/audit/{service}/{key}")
+async def audit_handler(request):
+    service = request.match_info["service"]
+    key = request.match_info["key"]
 
-    # Write and execute it.
-    await reply(f"\nUpdating job {service} with new jobspec ...\n")
-    with open(f"local/{service}.nomad", "w") as fp:
-        fp.write(jobspec)
-    await execute(f"nomad job run local/{service}.nomad", False)
+    if not CONFIG.is_valid_key(service, key):
+        return web.HTTPNotFound()
+
+    filters = {"service": service}
+    if "action" in request.query:
+        filters["action"] = request.query["action"]
+    try:
+        limit = min(int(request.query.get("limit", "100")), AUDIT_TAIL_LIMIT)
+    except ValueError:
+        return web.HTTPBadRequest()
+
+    lines = await asyncio.get_running_loop().run_in_executor(None, functools.partial(AUDIT_LOG.tail, limit, **filters))
+
+    response = web.StreamResponse()
+    response.headers["Content-Type"] = "text/event-stream"
+    response.set_status(200)
+    await response.prepare(request)
+
+    for line in lines:
+        await response.write(line.encode())
 
-    await reply(f"\nDeployed {version} to {service}\n")
     return response
 
 
@@ -310,23 +1242,27 @@ async def fallback(request):
     return web.HTTPNotFound()
 
 
-def handle_sighup(*args):
-    log.info("Reloading files ...")
-    global SERVICE_KEYS, SERVICES
-    SERVICE_KEYS = json.loads(open("local/service-keys.json").read())
-    SERVICES = json.loads(open("local/services.json").read())
-
-
 def main():
+    global CONFIG, METRICS_PORT
+
     logging.basicConfig(
         format="%(asctime)s %(levelname)-8s [%(name)s] %(message)s", datefmt="%Y-%m-%d %H:%M:%S", level=logging.INFO
     )
 
-    handle_sighup()
-    signal.signal(signal.SIGHUP, handle_sighup)
+    CONFIG = load_config()
 
     app = web.Application()
     app.middlewares.insert(0, remote_ip_header_middleware)
+    app.cleanup_ctx.append(config_reload_ctx)
+    app.cleanup_ctx.append(audit_log_ctx)
+    app.cleanup_ctx.append(nomad_client_ctx)
+    app.cleanup_ctx.append(http_session_ctx)
+    app.cleanup_ctx.append(drain_worker_ctx)
+    app.on_startup.append(deploy_queue_startup)
+
+    if len(sys.argv) > 2:
+        METRICS_PORT = int(sys.argv[2])
+        app.cleanup_ctx.append(metrics_site_ctx)
 
     app.add_routes(routes)
 
@@ -1,68 +1,674 @@
 import aiohttp
+import asyncio
+import collections
+import json
+import logging
 import os
+import re
 import sys
+import time
 
 from aiohttp import web
+from aiohttp.web_log import AccessLogger
 
 routes = web.RouteTableDef()
 
-NOMAD_HOST = None
+REMOTE_IP_HEADER = "cf-connecting-ip"
+
+# Cluster name -> URL of its Nomad, and local port -> cluster name.
+CLUSTERS = {}
+PORTS = {}
+# Requests under this prefix are answered by all clusters together.
+MERGED_PREFIX = "all"
+CF_ACCESS_HEADERS = {}
+POOL_LIMIT = int(os.getenv("POOL_LIMIT", "100"))
+KEEPALIVE_TIMEOUT = float(os.getenv("KEEPALIVE_TIMEOUT", "60"))
+CONNECT_TIMEOUT = float(os.getenv("CONNECT_TIMEOUT", "10"))
+DNS_CACHE_TTL = int(os.getenv("DNS_CACHE_TTL", "300"))
+CACHE_TTL = float(os.getenv("CACHE_TTL", "2"))
+CACHE_MAX_SIZE = int(os.getenv("CACHE_MAX_SIZE", str(32 * 1024 * 1024)))
+CACHE_ENTRY_MAX_SIZE = int(os.getenv("CACHE_ENTRY_MAX_SIZE", str(128 * 1024)))
+SESSION = None
+CACHE = None
+INFLIGHT = {}
+
+
+class Metric:
+    """
+    Minimal Prometheus metric, so the proxy needs nothing but aiohttp.
+    """
+
+    TYPE = None
+
+    def __init__(self, name, documentation, labelnames):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._values = {}
+
+        METRICS.append(self)
+
+    def _key(self, labels):
+        return tuple(labels[name] for name in self.labelnames)
+
+    def _format_labels(self, key, extra=None):
+        labels = [f'{name}="{value}"' for name, value in zip(self.labelnames, key)]
+        if extra:
+            labels.append(extra)
+        return "{" + ",".join(labels) + "}" if labels else ""
+
+    def expose(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.TYPE}"]
+        for key, value in sorted(self._values.items()):
+            lines.append(f"{self.name}{self._format_labels(key)} {value}")
+        return lines
+
+
+class Counter(Metric):
+    TYPE = "counter"
+
+    def inc(self, value=1, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + value
+
+
+class Gauge(Metric):
+    TYPE = "gauge"
+
+    def inc(self, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + 1
+
+    def dec(self, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) - 1
+
+
+class Histogram(Metric):
+    TYPE = "histogram"
+    # Blocking queries wait up to 5 minutes, so go well beyond that.
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        if key not in self._values:
+            self._values[key] = [[0] * len(self.BUCKETS), 0.0, 0]
+
+        buckets, _, _ = self._values[key]
+        for i, bucket in enumerate(self.BUCKETS):
+            if value <= bucket:
+                buckets[i] += 1
+        self._values[key][1] += value
+        self._values[key][2] += 1
+
+    def expose(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.TYPE}"]
+        for key, (buckets, total, count) in sorted(self._values.items()):
+            for bucket, value in zip(self.BUCKETS, buckets):
+                le = f'le="{bucket}"'
+                lines.append(f"{self.name}_bucket{self._format_labels(key, le)} {value}")
+            le = 'le="+Inf"'
+            lines.append(f"{self.name}_bucket{self._format_labels(key, le)} {count}")
+            lines.append(f"{self.name}_sum{self._format_labels(key)} {total}")
+            lines.append(f"{self.name}_count{self._format_labels(key)} {count}")
+        return lines
+
+
+METRICS = []
+REQUEST_DURATION = Histogram(
+    "nomad_proxy_request_duration_seconds", "Duration of a request, till the last byte.", ("endpoint", "method")
+)
+TIME_TO_FIRST_BYTE = Histogram(
+    "nomad_proxy_time_to_first_byte_seconds", "Time till the response headers are sent.", ("endpoint", "method")
+)
+REQUEST_BYTES = Counter("nomad_proxy_request_bytes_total", "Bytes received from clients.", ("endpoint",))
+RESPONSE_BYTES = Counter("nomad_proxy_response_bytes_total", "Bytes sent to clients, headers included.", ("endpoint",))
+OPEN_STREAMS = Gauge("nomad_proxy_open_streams", "Number of responses and WebSockets being relayed.", ("endpoint",))
+STREAMED_BYTES = Counter(
+    "nomad_proxy_streamed_bytes_total", "Bytes relayed to clients, counted as they are sent.", ("endpoint",)
+)
+CACHE_REQUESTS = Counter("nomad_proxy_cache_requests_total", "GET requests by how they were answered.", ("result",))
+
+# Paths are reduced to the endpoint they call, so metrics don't get a series per job or allocation.
+ENDPOINT_PATTERNS = [
+    (re.compile(r"^v1/client/fs/(\w+)/[^/]+"), r"/v1/client/fs/\1/:alloc"),
+    (re.compile(r"^v1/client/allocation/[^/]+/(\w+)"), r"/v1/client/allocation/:alloc/\1"),
+    (re.compile(r"^v1/var/"), "/v1/var/:path"),
+    (
+        re.compile(r"^v1/(job|allocation|node|evaluation|deployment|namespace|volume/csi|acl/token|acl/policy)/[^/]+"),
+        r"/v1/\1/:id",
+    ),
+    (re.compile(r"^ui(/|$)"), "/ui"),
+    (re.compile(r"^v1(/[\w-]+){1,3}"), r"/\g<0>"),
+]
+
+
+# Endpoints that stream; these cannot be merged.
+STREAMING_URLS = [
+    "v1/event/stream",
+    "v1/client/fs/",
+    "v1/agent/monitor",
+]
+# The listings every UI and CLI polls; only GETs of these are coalesced and cached.
+CACHEABLE_URLS = [
+    "v1/jobs",
+    "v1/nodes",
+    "v1/allocations",
+]
+# Headers that only make sense for a single connection, so are never passed on or replayed from the cache.
+HOP_BY_HOP_HEADERS = {"connection", "keep-alive", "transfer-encoding", "content-length"}
+
+CachedResponse = collections.namedtuple("CachedResponse", ["status", "headers", "body", "index"])
+
+
+class ResponseCache:
+    """
+    LRU cache of complete responses, bounded by the total size of their bodies.
+
+    Entries expire after a short TTL, as this is only meant to absorb the
+    polling of several clients looking at the same thing.
+    """
+
+    def __init__(self, ttl, max_size):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.size = 0
+        self._entries = collections.OrderedDict()
+
+    def get(self, key, index):
+        if key not in self._entries:
+            return None
+
+        expires, response = self._entries[key]
+        if expires < time.monotonic():
+            self._remove(key)
+            return None
+        # Nomad answers a blocking query right away if it has a newer index
+        # than asked for; in that case the cached response is just as good.
+        if index is not None and response.index <= index:
+            return None
+
+        self._entries.move_to_end(key)
+        return response
+
+    def put(self, key, response):
+        if len(response.body) > self.max_size:
+            return
+
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = (time.monotonic() + self.ttl, response)
+        self.size += len(response.body)
+
+        while self.size > self.max_size:
+            self._remove(next(iter(self._entries)))
+
+    def clear(self):
+        self._entries.clear()
+        self.size = 0
+
+    def _remove(self, key):
+        _, response = self._entries.pop(key)
+        self.size -= len(response.body)
+
+
+def is_streaming(tail):
+    return any(tail.startswith(url) for url in STREAMING_URLS)
+
+
+def is_cacheable(tail):
+    return tail in CACHEABLE_URLS
+
+
+async def read_limited(proxy_response):
+    """
+    Read a response from Nomad if it is no bigger than CACHE_ENTRY_MAX_SIZE.
+
+    Returns the body, or None and the chunks read so far if it turned out bigger.
+    """
+
+    if proxy_response.content_length is not None and proxy_response.content_length > CACHE_ENTRY_MAX_SIZE:
+        return None, []
+
+    chunks = []
+    size = 0
+    async for chunk in proxy_response.content.iter_any():
+        chunks.append(chunk)
+        size += len(chunk)
+        if size > CACHE_ENTRY_MAX_SIZE:
+            return None, chunks
+
+    return b"".join(chunks), None
+
+
+def to_cached_response(proxy_response, body):
+    response_headers = [
+        (name, value) for name, value in proxy_response.headers.items() if name.lower() not in HOP_BY_HOP_HEADERS
+    ]
+    index = proxy_response.headers.get("X-Nomad-Index")
+    index = int(index) if index and index.isdigit() else None
+
+    return CachedResponse(proxy_response.status, response_headers, body, index)
+
+
+async def lookup(request, host, tail, headers, encoding, relay=None):
+    """
+    Get a GET response from the cache, by joining an identical request already in flight, or from Nomad.
+
+    Only responses up to CACHE_ENTRY_MAX_SIZE are shared. Bigger ones are
+    handed to "relay" to be streamed to the client that asked for them,
+    while the requests that joined it make their own; lookup() then
+    returns what relay() returned. Without "relay", they are read
+    completely.
+
+    Returns the response and how it was found (None if it was relayed).
+    """
+
+    # Responses depend on who is asking, so never share them between tokens.
+    credentials = (request.headers.get("X-Nomad-Token"), request.headers.get("Authorization"))
+
+    # Blocking queries are cached under the same key as normal reads; the
+    # index of the cached response decides whether it can answer them.
+    index = request.query.get("index", "")
+    index = int(index) if index.isdigit() else None
+    query = tuple(sorted((name, value) for name, value in request.query.items() if name not in ("index", "wait")))
+    cache_key = (host, tail, query, credentials, encoding)
+
+    response = CACHE.get(cache_key, index) if CACHE is not None else None
+    if response is not None:
+        CACHE_REQUESTS.inc(result="hit")
+        return response, "HIT"
+    CACHE_REQUESTS.inc(result="miss")
+
+    flight_key = (host, tail, request.query_string, credentials, encoding)
+    flight = INFLIGHT.get(flight_key)
+    if flight is not None:
+        response = await asyncio.shield(flight)
+        if response is not None:
+            CACHE_REQUESTS.inc(result="coalesced")
+            return response, "COALESCED"
+
+    flight = asyncio.get_running_loop().create_future()
+    INFLIGHT.setdefault(flight_key, flight)
+
+    def settle(response):
+        # Whatever happens to this request, never leave the ones that joined it waiting.
+        if not flight.done():
+            flight.set_result(response)
+        if INFLIGHT.get(flight_key) is flight:
+            del INFLIGHT[flight_key]
+
+    try:
+        async with SESSION.get(f"{host}/{tail}?{request.query_string}", headers=headers) as proxy_response:
+            if relay is None:
+                body = await proxy_response.read()
+            else:
+                body, prefix = await read_limited(proxy_response)
+                if body is None:
+                    settle(None)
+                    return await relay(proxy_response, prefix), None
+
+        response = to_cached_response(proxy_response, body)
+        if CACHE is not None and response.status == 200 and len(body) <= CACHE_ENTRY_MAX_SIZE:
+            CACHE.put(cache_key, response)
+        settle(response)
+    finally:
+        settle(None)
+
+    return response, "MISS"
+
+
+async def proxy_cached(request, host, tail, headers):
+    """
+    Answer a GET from the cache, or by joining an identical request already in flight.
+    """
+
+    start = time.monotonic()
+
+    def relay(proxy_response, prefix):
+        return relay_response(request, proxy_response, tail, start, prefix)
+
+    # Bodies are kept as Nomad sent them, so they are only shared with clients accepting the same encoding.
+    response, status = await lookup(request, host, tail, headers, request.headers.get("Accept-Encoding"), relay)
+    if status is None:
+        return response
+
+    request["ttfb"] = time.monotonic() - start
+    result = web.Response(status=response.status, body=response.body, headers=response.headers)
+    result.headers["X-Nomad-Proxy-Cache"] = status
+    return result
+
+
+def normalize_endpoint(tail):
+    for pattern, replacement in ENDPOINT_PATTERNS:
+        match = pattern.match(tail)
+        if match:
+            return match.expand(replacement)
+    return "other"
+
+
+class MetricsAccessLogger(AccessLogger):
+    """
+    Log every request as a single JSON line, and record its metrics.
+    """
+
+    def log(self, request, response, time):
+        # Don't log the health-check and metrics; they are spammy.
+        if request.path in ("/healthz", "/metrics"):
+            return
+
+        endpoint = normalize_endpoint(request.get("tail", request.path[1:]))
+        ttfb = request.get("ttfb", time)
+        bytes_in = request.content.total_bytes
+        bytes_out = response.body_length
+
+        REQUEST_DURATION.observe(time, endpoint=endpoint, method=request.method)
+        TIME_TO_FIRST_BYTE.observe(ttfb, endpoint=endpoint, method=request.method)
+        REQUEST_BYTES.inc(bytes_in, endpoint=endpoint)
+        RESPONSE_BYTES.inc(bytes_out, endpoint=endpoint)
+
+        self.logger.info(
+            json.dumps(
+                {
+                    "remote": request.headers.get(REMOTE_IP_HEADER, request.remote),
+                    "method": request.method,
+                    "path": request.path,
+                    "endpoint": endpoint,
+                    "status": response.status,
+                    "cache": response.headers.get("X-Nomad-Proxy-Cache"),
+                    "ttfb": round(ttfb, 6),
+                    "duration": round(time, 6),
+                    "bytes_in": bytes_in,
+                    "bytes_out": bytes_out,
+                }
+            )
+        )
+
+
+@routes.get("/healthz")
+async def healthz_handler(request):
+    return web.HTTPOk()
+
+
+@routes.get("/metrics")
+async def metrics_handler(request):
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.expose())
+    return web.Response(text="\n".join(lines) + "\n", content_type="text/plain")
+
+
+async def proxy_merged(request, tail, headers):
+    """
+    Answer a GET by asking every cluster at once, and merging their answers.
+
+    Lists are concatenated, with the name of the cluster added to every
+    entry; anything else is returned as an object keyed by cluster name.
+    """
+
+    start = time.monotonic()
+
+    if request.method != "GET":
+        raise web.HTTPMethodNotAllowed(request.method, ["GET"])
+    if is_streaming(tail):
+        return web.Response(status=400, text="ERROR: streams cannot be merged\n")
+
+    # The answers have to be read here, so don't ask for them compressed.
+    headers = {name: value for name, value in headers.items() if name.lower() != "accept-encoding"}
+    headers["Accept-Encoding"] = "identity"
+
+    names = list(CLUSTERS)
+    results = await asyncio.gather(
+        *[lookup(request, CLUSTERS[name], tail, headers, "identity") for name in names], return_exceptions=True
+    )
+
+    merged = {}
+    for name, result in zip(names, results):
+        if isinstance(result, Exception):
+            return web.Response(status=502, text=f"ERROR: {name} failed: {result}\n")
+
+        response, _ = result
+        if response.status != 200:
+            return web.Response(status=502, text=f"ERROR: {name} returned {response.status}\n")
+        merged[name] = json.loads(response.body)
+
+    if all(isinstance(value, list) for value in merged.values()):
+        merged = [
+            dict(entry, Cluster=name) if isinstance(entry, dict) else entry
+            for name, value in merged.items()
+            for entry in value
+        ]
+
+    request["ttfb"] = time.monotonic() - start
+    return web.json_response(merged)
+
+
+WEBSOCKET_HEADERS = {
+    "upgrade",
+    "connection",
+    "sec-websocket-key",
+    "sec-websocket-version",
+    "sec-websocket-extensions",
+    "sec-websocket-protocol",
+}
+
+
+async def proxy_websocket(request, url, headers):
+    """
+    Relay a WebSocket (like "nomad alloc exec") frame by frame in both directions.
+    """
+
+    start = time.monotonic()
+    endpoint = normalize_endpoint(request["tail"])
+
+    # The handshake is done by aiohttp on both sides; only pass on the other headers.
+    headers = {name: value for name, value in headers.items() if name.lower() not in WEBSOCKET_HEADERS}
+    protocols = [
+        protocol.strip()
+        for protocol in request.headers.get("Sec-WebSocket-Protocol", "").split(",")
+        if protocol.strip()
+    ]
+
+    async with SESSION.ws_connect(url, headers=headers, protocols=protocols, max_msg_size=0) as upstream:
+        downstream = web.WebSocketResponse(protocols=[upstream.protocol] if upstream.protocol else (), max_msg_size=0)
+        await downstream.prepare(request)
+        request["ttfb"] = time.monotonic() - start
+
+        async def relay(source, target):
+            # Sending waits for the transport to drain, so a slow side slows down the other.
+            async for message in source:
+                if message.type == aiohttp.WSMsgType.TEXT:
+                    await target.send_str(message.data)
+                elif message.type == aiohttp.WSMsgType.BINARY:
+                    await target.send_bytes(message.data)
+                else:
+                    break
+
+                if target is downstream:
+                    STREAMED_BYTES.inc(len(message.data), endpoint=endpoint)
+
+        tasks = [
+            asyncio.ensure_future(relay(downstream, upstream)),
+            asyncio.ensure_future(relay(upstream, downstream)),
+        ]
+        OPEN_STREAMS.inc(endpoint=endpoint)
+        try:
+            await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            OPEN_STREAMS.dec(endpoint=endpoint)
+            for task in tasks:
+                task.cancel()
+
+        # Whichever side closed first, close the other with the same code.
+        code = downstream.close_code or upstream.close_code or aiohttp.WSCloseCode.OK
+        await upstream.close(code=code)
+        await downstream.close(code=code)
+        return downstream
+
+
+async def relay_response(request, proxy_response, tail, start, prefix=()):
+    """
+    Stream a response from Nomad to the client; "prefix" are chunks of it that were already read.
+    """
+
+    response = web.StreamResponse()
+    response.headers.update(proxy_response.headers)
+    response.set_status(proxy_response.status)
+
+    endpoint = normalize_endpoint(tail)
+    OPEN_STREAMS.inc(endpoint=endpoint)
+    try:
+        await response.prepare(request)
+        request["ttfb"] = time.monotonic() - start
+
+        for chunk in prefix:
+            await response.write(chunk)
+            STREAMED_BYTES.inc(len(chunk), endpoint=endpoint)
+
+        # Relay whatever has arrived as one chunk; fewer, larger writes cost less
+        # CPU per MB than passing on every buffer as received. Writing waits for
+        # the client to drain, which in turn pauses reading from Nomad.
+        async for chunk in proxy_response.content.iter_any():
+            await response.write(chunk)
+            STREAMED_BYTES.inc(len(chunk), endpoint=endpoint)
+    finally:
+        OPEN_STREAMS.dec(endpoint=endpoint)
+    return response
 
 
 @routes.route("*", "/{tail:.*}")
 async def proxy(request):
-    headers = dict(request.headers)
-    del headers["Host"]
-    headers["CF-Access-Client-Id"] = os.getenv("CF_ACCESS_CLIENT_ID")
-    headers["CF-Access-Client-Secret"] = os.getenv("CF_ACCESS_CLIENT_SECRET")
+    start = time.monotonic()
+    # The connection to Nomad is a different one; aiohttp frames the body for it.
+    headers = {
+        name: value
+        for name, value in request.headers.items()
+        if name.lower() != "host" and name.lower() not in HOP_BY_HOP_HEADERS
+    }
+    # Only ask Nomad for an encoding the client can handle, so compressed bodies can be passed on untouched.
+    if "Accept-Encoding" not in request.headers:
+        headers["Accept-Encoding"] = "identity"
+    headers.update(CF_ACCESS_HEADERS)
+
+    # "/<cluster>/..." picks a cluster by name; otherwise it is the cluster of the port the request came in on.
+    tail = request.match_info["tail"]
+    prefix, _, rest = tail.partition("/")
+    if prefix == MERGED_PREFIX:
+        request["tail"] = rest
+        return await proxy_merged(request, rest, headers)
+    if prefix in CLUSTERS:
+        host, tail = CLUSTERS[prefix], rest
+    else:
+        host = CLUSTERS[PORTS[request.transport.get_extra_info("sockname")[1]]]
+    request["tail"] = tail
 
-    data = await request.text()
+    if request.headers.get("Upgrade", "").lower() == "websocket":
+        return await proxy_websocket(request, f"{host}/{tail}?{request.query_string}", headers)
 
-    async with aiohttp.ClientSession() as session:
-        command = getattr(session, request.method.lower())
+    if request.method == "GET" and is_cacheable(tail):
+        return await proxy_cached(request, host, tail, headers)
+    # Anything else may change what Nomad returns.
+    if request.method != "GET" and CACHE is not None:
+        CACHE.clear()
 
-        async with command(
-            f"https://{NOMAD_HOST}/{request.match_info['tail']}?{request.query_string}", data=data, headers=headers
-        ) as proxy_response:
-            response = web.StreamResponse()
-            response.headers.update(proxy_response.headers)
-            response.set_status(proxy_response.status)
+    # Stream the body to the upstream as it comes in, instead of buffering it.
+    data = request.content if request.body_exists else None
 
-            # We decompressed the response, so we need to remove the Content-Encoding / Content-Length header.
-            if "Content-Encoding" in response.headers:
-                del response.headers["Content-Encoding"]
-            if "Content-Length" in response.headers:
-                del response.headers["Content-Length"]
+    command = getattr(SESSION, request.method.lower())
+    async with command(f"{host}/{tail}?{request.query_string}", data=data, headers=headers) as proxy_response:
+        return await relay_response(request, proxy_response, tail, start)
 
-            await response.prepare(request)
 
-            # Handle streaming data.
-            while not proxy_response.content.is_eof():
-                while not proxy_response.content._buffer and not proxy_response.content._eof:
-                    await proxy_response.content._wait("read")
-                await response.write(proxy_response.content.read_nowait(-1))
+async def upstream_session_ctx(app):
+    """
+    Keep a single pool of keep-alive connections to Nomad for the lifetime of the proxy.
 
-            # Read the remaining of the existing buffer.
-            await response.write(proxy_response.content.read_nowait(-1))
-            return response
+    This avoids a TLS handshake through Cloudflare Access for every request.
+    """
+
+    global SESSION
+
+    connector = aiohttp.TCPConnector(limit=POOL_LIMIT, keepalive_timeout=KEEPALIVE_TIMEOUT, ttl_dns_cache=DNS_CACHE_TTL)
+    # Only bound connecting; streams and blocking queries legitimately stay open for a long time.
+    timeout = aiohttp.ClientTimeout(total=None, sock_connect=CONNECT_TIMEOUT)
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout, auto_decompress=False) as session:
+        SESSION = session
+        yield
+        SESSION = None
+
+
+def parse_clusters(args):
+    """
+    Parse pairs of "[<name>=]<nomad-host> <port>" into CLUSTERS and PORTS.
+    """
+
+    if not args or len(args) % 2:
+        return False
+
+    for target, port in zip(args[::2], args[1::2]):
+        name, _, host = target.rpartition("=")
+        if "://" not in host:
+            host = f"https://{host}"
+        # Without a name, use the hostname; "nomad-aws.openttd.org" becomes "aws".
+        if not name:
+            name = host.split("://", 1)[1].split(".")[0].removeprefix("nomad-")
+
+        if name in CLUSTERS or name in (MERGED_PREFIX, "v1", "ui") or not port.isdigit() or int(port) in PORTS:
+            return False
+
+        CLUSTERS[name] = host
+        PORTS[int(port)] = name
+    return True
+
+
+async def serve(app):
+    """
+    Listen on the port of every cluster; they all share the same application, and so the same connection pool.
+    """
+
+    runner = web.AppRunner(app, access_log_class=MetricsAccessLogger)
+    await runner.setup()
+    try:
+        for port, name in PORTS.items():
+            await web.TCPSite(runner, port=port).start()
+            print(f"Proxying {CLUSTERS[name]} on http://localhost:{port} (or http://localhost:{port}/{name})")
+        if len(CLUSTERS) > 1:
+            print(f"Merged read-only view of all clusters on http://localhost:{next(iter(PORTS))}/{MERGED_PREFIX}")
+
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
 
 
 def main():
-    global NOMAD_HOST
+    global CACHE
 
-    if len(sys.argv) != 3:
-        print(f"Usage: {sys.argv[0]} <nomad-host> <nomad-port>")
+    if not parse_clusters(sys.argv[1:]):
+        print(f"Usage: {sys.argv[0]} [<name>=]<nomad-host> <nomad-port> [[<name>=]<nomad-host> <nomad-port> ...]")
         sys.exit(1)
 
     if not os.getenv("CF_ACCESS_CLIENT_ID") or not os.getenv("CF_ACCESS_CLIENT_SECRET"):
         print("CF_ACCESS_CLIENT_ID and CF_ACCESS_CLIENT_SECRET environment variables need to be set.")
         sys.exit(1)
 
-    NOMAD_HOST = sys.argv[1]
+    CF_ACCESS_HEADERS["CF-Access-Client-Id"] = os.getenv("CF_ACCESS_CLIENT_ID")
+    CF_ACCESS_HEADERS["CF-Access-Client-Secret"] = os.getenv("CF_ACCESS_CLIENT_SECRET")
+
+    logging.basicConfig(
+        format="%(asctime)s %(levelname)-8s [%(name)s] %(message)s", datefmt="%Y-%m-%d %H:%M:%S", level=logging.INFO
+    )
+
+    if CACHE_TTL > 0:
+        CACHE = ResponseCache(CACHE_TTL, CACHE_MAX_SIZE)
 
     app = web.Application()
+    app.cleanup_ctx.append(upstream_session_ctx)
     app.add_routes(routes)
-    web.run_app(app, port=int(sys.argv[2]))
+
+    try:
+        asyncio.run(serve(app))
+    except KeyboardInterrupt:
+        pass
 
 
 if __name__ == "__main__":
@@ -1,7 +1,7 @@
 #!/bin/sh
 
 if [ -z "${1}" ]; then
-    echo "Usage: ${0} [aws|oci]"
+    echo "Usage: ${0} [aws|oci|oci-migrate|all]"
     exit 1
 fi
 
@@ -22,6 +22,9 @@ elif [ "${1}" = "oci" ]; then
 elif [ "${1}" = "oci-migrate" ]; then
     port=4848
     hostname="oci"
+elif [ "${1}" = "all" ]; then
+    # Both clusters from a single process; this also gives a merged view on http://localhost:4848/all/.
+    exec .env/bin/python -m nomad-proxy nomad-aws.openttd.org 4848 nomad-oci.openttd.org 4747
 else
     echo "Invalid cloud provider: ${1}"
     exit 1